@@ -12,141 +12,1022 @@
 
 import os
 import re
+import json
+import filecmp
+import pickle
 import posixpath
+import time
+import threading
 import traceback
-import pkg_resources
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
 from docutils import nodes
-from sphinx import addnodes
+from docutils.parsers import rst
+from sphinx.config import ENUM
 from sphinx.util import logging
 from sphinx.util.osutil import ensuredir
 
-import blockdiag.utils.rst.nodes
-import blockdiag.utils.rst.directives
-from blockdiag.utils.bootstrap import detectfont, Application
-from blockdiag.utils.fontmap import FontMap
-from blockdiag.utils.rst.directives import with_blockdiag
+# blockdiag (and PIL, reportlab and pkg_resources through it) is imported on
+# the first diagram; loading Sphinx projects without diagrams stays cheap.
 
-# fontconfig; it will be initialized on `builder-inited` event.
+# fontconfig; it will be initialized on the first use (see get_fontmap()).
 fontmap = None
 
+# fontmaps resolved in this process (keyed by the font settings and mtimes of the files)
+fontmaps = {}
+
+# font objects shared between diagrams in the current build (keyed by format, path and size)
+loaded_fonts = {}
+
+# LRU cache of text metrics (keyed by format, font path, size and text); see cache_text_metrics().
+TEXT_METRICS_CACHE_SIZE = 8192
+text_metrics = OrderedDict()
+text_metrics_lock = threading.Lock()
+
+# hits and misses of text_metrics in the current thread; see measure().
+text_metrics_stats = threading.local()
+
+# thread pool drawing PNG images in background and the diagrams queued to it (keyed by path);
+# see defer_render().
+render_executor = None
+deferred_renders = {}
+
+# compaction of SVG documents; see write_optimized_svg()
+SVG_PRECISION = 2
+SVG_NUMBER_PATTERN = re.compile(r'-?\d+\.\d+')
+SVG_GEOMETRY_ATTRIBUTES = frozenset(['x', 'y', 'width', 'height', 'cx', 'cy', 'rx', 'ry',
+                                     'd', 'points', 'textLength', 'transform', 'viewBox'])
+SVG_STYLE_ATTRIBUTES = frozenset(['fill', 'stroke', 'stroke-width', 'stroke-dasharray', 'font-family',
+                                  'font-size', 'font-style', 'font-weight', 'text-anchor'])
+SVG_DEFAULT_ATTRIBUTES = frozenset([('font-style', 'normal'), ('font-weight', 'normal')])
+
+# builders embedding images or not (keyed by builder name; unknown builders do);
+# blockdiag_builder_images overrides it.  See embeds_images().
+BUILDER_IMAGE_SUPPORT = {
+    'changes': False,
+    'dummy': False,
+    'gettext': False,
+    'linkcheck': False,
+    'man': False,
+    'pseudoxml': False,
+    'text': False,
+    'xml': False,
+}
+
+# diagrams which have exceeded blockdiag_render_timeout (keyed by path); they are not
+# rendered again in the build.  See call_with_watchdog().
+timed_out_renders = set()
+
+# seconds to wait for other processes rendering the same image
+LOCK_TIMEOUT = 60
+
+# render locks taken by this process (lockpath -> pid); a lock file having our pid
+# is left by a killed process which had the same pid unless it is listed here.
+held_locks = {}
+held_locks_mutex = threading.Lock()
+
+# URIs of :ref: hrefs resolved in the current build (keyed by docname and label)
+REFERENCE_PATTERN = re.compile("^:ref:`(.+?)`", re.UNICODE)
+resolved_references = {}
+
+# directive class built on blockdiag's one; see get_directive_class().
+directive_class = None
+
+# options for the image filenames and their fingerprints in the current build
+# (keyed by image format); see blockdiag_node.get_settings().
+render_settings = {}
+
+# directories already created in the current build; see ensure_dir().
+ensured_dirs = set()
+
+# metadata and SVG of diagrams rendered in the current build (keyed by path)
+registry = {}
+
+# the numbers of diagrams reused and regenerated in this process; parallel
+# writers pass them to the main process (see on_html_page_context()).
+render_counts = dict(reused=0, regenerated=0)
+counts_pid = None
+main_pid = None
+
+# SVG images in the cache used in the current build; see prune_images()
+used_svg_files = set()
+
+# timings of images rendered by blockdiag_render_workers (keyed by path); they
+# are recorded on their first use in the write phase.  See record_render().
+prerendered_images = {}
+
+# metadata of diagrams rendered in the previous builds (keyed by image filename);
+# it will be loaded on `builder-inited` event.  See compact_metadata().
+METADATA_INDEX = 'metadata.pickle'
+METADATA_INDEX_VERSION = 1
+metadata_index = {}
+
+# normalized code and complexity of diagrams parsed in the previous builds
+# (keyed by digest); it will be initialized on `env-before-read-docs` event.
+parsed_diagrams = {}
+
 logger = logging.getLogger(__name__)
 
 
-class blockdiag_node(blockdiag.utils.rst.nodes.blockdiag):
+PHASES = ('parse', 'layout', 'draw', 'save')
+
+# keys of measure_complexity() and the configurations limiting them
+COMPLEXITY_LIMITS = (('nodes', 'blockdiag_max_nodes'),
+                     ('edges', 'blockdiag_max_edges'),
+                     ('depth', 'blockdiag_max_group_depth'))
+
+
+@contextmanager
+def measure(timings, name):
+    started = time.perf_counter()
+    hits = getattr(text_metrics_stats, 'hits', 0)
+    misses = getattr(text_metrics_stats, 'misses', 0)
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - started
+        timings['text_metrics_hits'] = (timings.get('text_metrics_hits', 0) +
+                                        getattr(text_metrics_stats, 'hits', 0) - hits)
+        timings['text_metrics_misses'] = (timings.get('text_metrics_misses', 0) +
+                                          getattr(text_metrics_stats, 'misses', 0) - misses)
+
+
+def load_blockdiag():
+    import blockdiag.builder
+    import blockdiag.drawer
+    import blockdiag.parser
+
+    return blockdiag
+
+
+def __getattr__(name):
+    # backward compatibility: ``sphinxcontrib.blockdiag.blockdiag`` was a module global
+    if name == 'blockdiag':
+        return load_blockdiag()
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class blockdiag_node(nodes.General, nodes.Element):
+    name = 'blockdiag'
+
+    @property
+    def processor(self):
+        return load_blockdiag()
+
+    def to_diagram(self, timings=None, preflight=None):
+        """Parse the code and lay the diagram out.
+
+        Based on ``blockdiag.utils.rst.nodes.blockdiag.to_diagram()``; the
+        code is normalized in the same way (see tests/test_compat.py).
+
+        *preflight* is called with the complexity of the diagram before
+        layout; it can raise an exception to refuse the diagram.
+        """
+        if timings is None:
+            timings = {}
+
+        with measure(timings, 'parse'):
+            try:
+                tree = self.processor.parser.parse_string(self['code'])
+            except Exception:
+                code = '%s { %s }' % (self.name, self['code'])
+                tree = self.processor.parser.parse_string(code)
+                self['code'] = code  # replace if succeeded
+
+            self['complexity'] = measure_complexity(tree)
+
+        if preflight is not None:
+            preflight(self['complexity'])
+
+        with measure(timings, 'layout'):
+            return self.processor.builder.ScreenNodeBuilder.build(tree)
+
     def to_drawer(self, image_format, builder, **kwargs):
         if 'filename' in kwargs:
             filename = kwargs.pop('filename')
         else:
             filename = self.get_abspath(image_format, builder)
+        resolve_references = kwargs.pop('resolve_references', True)
+        timings = kwargs.pop('timings', {})
 
         antialias = builder.config.blockdiag_antialias
         transparency = builder.config.blockdiag_transparency
-        image = super(blockdiag_node, self).to_drawer(image_format, filename, fontmap,
+        diagram = self.to_diagram(timings)
+        with measure(timings, 'layout'):
+            image = self.processor.drawer.DiagramDraw(image_format, diagram, filename,
+                                                      fontmap=get_fontmap(builder.config),
                                                       antialias=antialias, transparency=transparency,
                                                       **kwargs)
-        for node in image.diagram.traverse_nodes():
-            node.href = resolve_reference(builder, node.href)
+        if resolve_references:
+            for node in image.diagram.traverse_nodes():
+                node.href = resolve_reference(builder, node.href)
 
         return image
 
-    def get_relpath(self, image_format, builder):
+    def get_options(self, image_format, builder):
         options = dict(antialias=builder.config.blockdiag_antialias,
                        fontpath=builder.config.blockdiag_fontpath,
                        fontmap=builder.config.blockdiag_fontmap,
                        format=image_format,
                        transparency=builder.config.blockdiag_transparency)
-        return posixpath.join(builder.imgpath, self.get_path(**options))
+        if image_format == 'SVG':
+            if get_svg_precision(builder.config) is not None:
+                options['svg_precision'] = get_svg_precision(builder.config)
+            if builder.config.blockdiag_html_svg_embed == 'file':
+                options['svg_embed'] = 'file'
+
+        return options
+
+    def get_path(self, **options):
+        # same as blockdiag.utils.rst.nodes.blockdiag.get_path() without outputdir;
+        # the filenames must not change (see tests/test_compat.py)
+        options.update(self['options'])
+        hashseed = (self['code'] + str(options)).encode('utf-8')
+        hashed = sha1(hashseed).hexdigest()
+
+        return "%s-%s.%s" % (self.name, hashed, options['format'].lower())
+
+    def get_settings(self, image_format, builder):
+        """Return the options for get_path() and their fingerprint.
+
+        They are computed once per build and image format.
+        """
+        if image_format not in render_settings:
+            options = self.get_options(image_format, builder)
+            fingerprint = sha1(repr(sorted(options.items())).encode('utf-8')).hexdigest()
+            render_settings[image_format] = (options, fingerprint)
+
+        return render_settings[image_format]
+
+    def describe(self, image_format, builder):
+        """Store the filename of the image to the node (on reading documents)."""
+        options, fingerprint = self.get_settings(image_format, builder)
+        self['descriptor'] = (fingerprint, self.get_path(**options))
+
+    def get_filename(self, image_format, builder):
+        """Return the filename of the image (``blockdiag-<hash>.<ext>``).
+
+        The one stored by describe() is used unless the settings have been
+        changed since the document was read.
+        """
+        options, fingerprint = self.get_settings(image_format, builder)
+        descriptor = self.get('descriptor')
+        if descriptor is not None and descriptor[0] == fingerprint:
+            return descriptor[1]
+        else:
+            return self.get_path(**options)
+
+    def get_relpath(self, image_format, builder):
+        return posixpath.join(builder.imgpath, self.get_filename(image_format, builder))
 
     def get_abspath(self, image_format, builder):
-        options = dict(antialias=builder.config.blockdiag_antialias,
-                       fontpath=builder.config.blockdiag_fontpath,
-                       fontmap=builder.config.blockdiag_fontmap,
-                       format=image_format,
-                       transparency=builder.config.blockdiag_transparency)
+        dirname = os.path.join(builder.outdir, builder.imagedir)
+        ensure_dir(dirname)
 
-        path = os.path.join(builder.outdir, builder.imagedir, self.get_path(**options))
-        ensuredir(os.path.dirname(path))
+        return os.path.join(dirname, self.get_filename(image_format, builder))
+
+    def get_cachepath(self, image_format, builder):
+        dirname = os.path.join(builder.doctreedir, 'blockdiag')
+        ensure_dir(dirname)
+
+        return os.path.join(dirname, self.get_filename(image_format, builder))
+
+
+class ComplexityError(Exception):
+    pass
+
+
+def measure_complexity(tree):
+    """Count the nodes, edges and groups of a parsed diagram.
+
+    It works on the parse tree; the diagram does not need to be laid out.
+    """
+    parser = load_blockdiag().parser
+    node_ids = set()
+    group_ids = set()
+    complexity = dict(nodes=0, edges=0, groups=0, depth=0)
+
+    def walk(stmts, depth):
+        for stmt in stmts:
+            if isinstance(stmt, parser.Statements):
+                walk(stmt.stmts, depth)
+            elif isinstance(stmt, parser.Group):
+                group_ids.add(stmt.id)
+                complexity['groups'] += 1
+                complexity['depth'] = max(complexity['depth'], depth + 1)
+                walk(stmt.stmts, depth + 1)
+            elif isinstance(stmt, parser.Node):
+                node_ids.add(stmt.id)
+            elif isinstance(stmt, parser.Edge):
+                node_ids.update(stmt.from_nodes + stmt.to_nodes)
+                complexity['edges'] += len(stmt.from_nodes) * len(stmt.to_nodes)
+
+    walk(tree.stmts, 0)
+    complexity['nodes'] = len(node_ids - group_ids)  # edges can also connect groups
+    complexity['cost'] = estimate_cost(complexity['nodes'], complexity['edges'], complexity['groups'])
+    return complexity
+
+
+def estimate_cost(nodes, edges, groups=0):
+    """Estimate the cost to render a diagram.
+
+    Drawing dominates the rendering and its time grows linearly with the
+    number of shapes; so the cost is the number of shapes to draw.
+    """
+    return nodes + edges + groups
+
+
+def check_complexity(complexity, config):
+    """Return the limits (``blockdiag_max_*``) exceeded by the diagram."""
+    exceeded = []
+    for key, name in COMPLEXITY_LIMITS:
+        limit = getattr(config, name)
+        if limit is not None and complexity[key] > int(limit):  # a string if given by -D option
+            exceeded.append('%d %s (%s = %d)' % (complexity[key], key, name, int(limit)))
+
+    return exceeded
+
+
+def ensure_dir(dirname):
+    if dirname not in ensured_dirs:
+        ensuredir(dirname)
+        ensured_dirs.add(dirname)
+
+
+# copied from blockdiag.utils.rst.directives not to import blockdiag on loading
+# the extension; see tests/test_compat.py
+def align(argument):
+    return rst.directives.choice(argument, ('left', 'center', 'right'))
+
+
+def figwidth_value(argument):
+    if argument.lower() == 'image':
+        return 'image'
+    else:
+        return rst.directives.length_or_percentage_or_unitless(argument, 'px')
+
+
+class Blockdiag(rst.Directive):
+    """The ``blockdiag`` directive.
+
+    The options are the same as blockdiag's directive; they are declared here
+    so that blockdiag is not imported until a diagram is found.
+    """
+    has_content = True
+    required_arguments = 0
+    optional_arguments = 1
+    final_argument_whitespace = False
+    # same as blockdiag.utils.rst.directives.BlockdiagDirectiveBase.option_spec
+    option_spec = {
+        'alt': rst.directives.unchanged,
+        'height': rst.directives.length_or_unitless,
+        'width': rst.directives.length_or_percentage_or_unitless,
+        'scale': rst.directives.percentage,
+        'align': align,
+        'caption': rst.directives.unchanged,
+        'desctable': rst.directives.flag,
+        'maxwidth': rst.directives.nonnegative_int,  # deprecated
+        'name': rst.directives.unchanged,
+        'class': rst.directives.class_option,
+        'figwidth': figwidth_value,
+        'figclass': rst.directives.class_option,
+    }
+
+    def run(self):
+        directive = get_directive_class()(self.name, self.arguments, self.options, self.content, self.lineno,
+                                          self.content_offset, self.block_text, self.state, self.state_machine)
+        return directive.run()
+
+
+def get_directive_class():
+    global directive_class
+    if directive_class is not None:
+        return directive_class
+
+    from blockdiag.utils.rst.directives import BlockdiagDirective
+
+    class BlockdiagImpl(BlockdiagDirective):
+        node_class = blockdiag_node
 
-        return path
+        def node2diagram(self, node):
+            node['digest'] = sha1(node['code'].encode('utf-8')).hexdigest()
+            if node['digest'] in parsed_diagrams and 'desctable' not in node['options']:
+                # already validated in the previous build; skip parsing and layout
+                node['code'], node['complexity'] = parsed_diagrams[node['digest']]
+                self.preflight(node['complexity'])
+                return None
 
+            return node.to_diagram(preflight=self.preflight)
 
-class Blockdiag(blockdiag.utils.rst.directives.BlockdiagDirective):
-    node_class = blockdiag_node
+        def preflight(self, complexity):
+            env = self.state.document.settings.env
+            exceeded = check_complexity(complexity, env.config)
+            if not exceeded:
+                return
+
+            message = 'diagram is too complex: %s' % ', '.join(exceeded)
+            if env.config.blockdiag_complexity_action == 'warn':
+                logger.warning(message, location=(env.docname, self.lineno))
+            else:
+                raise ComplexityError(message)
+
+        def node2image(self, node, diagram):
+            return node
+
+    directive_class = BlockdiagImpl
+    return directive_class
 
-    def node2image(self, node, diagram):
-        return node
 
+def resolve_reference(builder, href, from_images=False):
+    """Resolve a :ref: href for the current document.
 
-def resolve_reference(builder, href):
+    If *from_images* is true, the URI is made relative to the image
+    directory instead; it is used in SVG files there.
+    """
     if href is None:
         return None
 
-    pattern = re.compile("^:ref:`(.+?)`", re.UNICODE)
-    matched = pattern.search(href)
+    matched = REFERENCE_PATTERN.search(href)
     if matched is None:
         return href
     elif not hasattr(builder, 'current_docname'):  # ex. latex builder
         return matched.group(1)
     else:
         refid = matched.group(1)
-        domain = builder.env.domains['std']
-        node = addnodes.pending_xref(refexplicit=False)
-        xref = domain.resolve_xref(builder.env, builder.current_docname, builder,
-                                   'ref', refid, node, node)
-        if xref:
-            if 'refid' in xref:
-                return "#" + xref['refid']
+        key = (None if from_images else builder.current_docname, refid)
+        if key not in resolved_references:
+            resolved_references[key] = lookup_reference(builder, *key)
+
+        uri = resolved_references[key]
+        if uri is None:
+            logger.warning('undefined label: %s', refid)
+
+        return uri
+
+
+def lookup_reference(builder, fromdocname, refid):
+    # anonlabels of the std domain contains all labels (including the labels for sections)
+    docname, labelid = builder.env.domains['std'].anonlabels.get(refid, (None, None))
+    if docname is None:
+        return None
+    elif fromdocname is None:  # from the image directory
+        root = posixpath.relpath('.', builder.imagedir.replace(os.path.sep, '/'))
+        uri = posixpath.join(root, builder.get_target_uri(docname))
+    elif docname == fromdocname:
+        return '#' + labelid
+    else:
+        uri = builder.get_relative_uri(fromdocname, docname)
+
+    if labelid:
+        uri += '#' + labelid
+
+    return uri
+
+
+def get_svg_cachepath(path, hrefs):
+    hashed = sha1(json.dumps(hrefs).encode('utf-8')).hexdigest()
+    return '%s-%s.svg' % (os.path.splitext(path)[0], hashed)
+
+
+def load_svg(builder, path):
+    # not kept in memory; the body of the document holds it until written, and
+    # reading the file again for a repeated diagram is cheap
+    fetch_from_cache(builder, path)
+    try:
+        with open(path, encoding='utf-8') as fp:
+            return fp.read()
+    except OSError:
+        return None
+
+
+def write_svg(image, size, path, precision=None, link_target=None):
+    """Serialize an SVG image to *path* element by element.
+
+    ``image.save()`` builds the whole document in a StringIO and copies it
+    out as a string; the elements are written through the file buffer here
+    instead, so the document exists in memory only once, when it is read
+    back into the HTML body.
+
+    If *precision* is given, the document is optimized on the way; see
+    write_optimized_svg().  *link_target* is set to the target attribute
+    of links; it is required to follow them from an <object> element.
+    """
+    from blockdiag.imagedraw import simplesvg
+
+    # the drawer is wrapped by a filter replaying the drawing calls on save()
+    drawer = getattr(image.drawer, 'target', image.drawer)
+    with open_atomically(path, 'w', encoding='utf-8') as fp:
+        def save(filename, size, _format):
+            if size:
+                drawer.svg.attributes['width'] = size[0]
+                drawer.svg.attributes['height'] = size[1]
+
+            if link_target:
+                set_link_target(drawer.svg, link_target)
+
+            if precision is not None:
+                write_optimized_svg(drawer.svg, fp, precision)
+            else:
+                # the base serializer; svg.to_xml() collects the output in a StringIO
+                simplesvg.base.to_xml(drawer.svg, fp)
+
+        drawer.save = save
+        image.save(size)
+
+
+def set_link_target(element, target):
+    if element.__class__.__name__ == 'a':
+        element.attributes['target'] = target
+
+    for child in element.elements:
+        set_link_target(child, target)
+
+
+def get_svg_options(config):
+    """Return the options for write_svg()."""
+    return dict(precision=get_svg_precision(config),
+                link_target='_top' if config.blockdiag_html_svg_embed == 'file' else None)
+
+
+def get_svg_precision(config):
+    """Return the digits to round SVG coordinates to (None: not optimized)."""
+    value = config.blockdiag_svg_optimize
+    if value is True:
+        return SVG_PRECISION
+    elif value is False or value is None:
+        return None
+    else:
+        return int(value)
+
+
+def write_optimized_svg(document, fp, precision):
+    """Serialize an SVG document compactly.
+
+    Coordinates are rounded to *precision* digits, whitespace between
+    elements and attributes only meaningful to Inkscape are dropped, and
+    presentation attributes repeated in the diagram are moved to classes.
+    The classes are named by the hash of their declarations, so inline SVGs
+    on the same page never conflict.
+    """
+    from collections import Counter
+    from blockdiag.imagedraw.simplesvg import _escape, _quote
+
+    def round_number(matched):
+        number = '%.*f' % (precision, float(matched.group(0)))
+        if '.' in number:
+            number = number.rstrip('0').rstrip('.')
+        return '0' if number == '-0' else number
+
+    def optimize(element):
+        attributes = []
+        declarations = []
+        for key in sorted(element.attributes):
+            value = element.attributes[key]
+            if value is None or 'inkspace' in key:
+                continue
+
+            value = str(value)
+            if (key, value) in SVG_DEFAULT_ATTRIBUTES:
+                continue
+            if key in SVG_GEOMETRY_ATTRIBUTES and element.__class__.__name__ != 'filter':
+                value = SVG_NUMBER_PATTERN.sub(round_number, value)
+
+            if key == 'style':
+                declarations.append(value.rstrip(';'))
+            elif key in SVG_STYLE_ATTRIBUTES:
+                if key == 'font-size':
+                    value += 'px'
+                declarations.append('%s:%s' % (key, value))
             else:
-                return xref['refuri']
+                attributes.append((key, value))
+
+        return attributes, ';'.join(declarations)
+
+    def walk(element):
+        if element.__class__.__name__ == 'desc' and not element.text and not element.elements:
+            return  # empty description
+
+        yield element
+        for child in element.elements:
+            for descendant in walk(child):
+                yield descendant
+
+    elements = [(element, optimize(element)) for element in walk(document)]
+    counts = Counter(style for _, (_, style) in elements if style)
+    classes = {}
+    for style, count in counts.items():
+        if count > 1:
+            classes[style] = '%s-%s' % (blockdiag_node.name, sha1(style.encode('utf-8')).hexdigest()[:8])
+
+    optimized = {}
+    for element, (attributes, style) in elements:
+        if style in classes:
+            attributes.append(('class', classes[style]))
+        elif style:
+            attributes.append(('style', style))
+        optimized[id(element)] = attributes
+
+    def write(element):
+        name = element.__class__.__name__
+        fp.write('<%s' % name)
+        for key, value in optimized[id(element)]:
+            fp.write(' %s=%s' % (_escape(key), _quote(value)))
+
+        children = [e for e in element.elements if id(e) in optimized]
+        if element is document and classes:
+            fp.write('><style>')
+            for style, classname in sorted(classes.items(), key=lambda item: item[1]):
+                fp.write('.%s{%s}' % (classname, _escape(style)))
+            fp.write('</style>')
+        elif element.text is None and not children:
+            fp.write('/>')
+            return
         else:
-            logger.warning('undefined label: %s', refid)
-            return None
+            fp.write('>')
+
+        if element.text is not None:
+            fp.write(_escape(element.text))
+        for child in children:
+            write(child)
+        fp.write('</%s>' % name)
+
+    write(document)
+
+
+def get_cache_dir(builder):
+    """Returns the directory of the shared render cache for this version of blockdiag."""
+    import blockdiag
+
+    if builder.config.blockdiag_cache_dir:
+        rootdir = os.path.join(builder.confdir, os.path.expanduser(builder.config.blockdiag_cache_dir))
+        return os.path.join(rootdir, blockdiag.__version__)
+    else:
+        return None
+
+
+def fetch_from_cache(builder, path):
+    """Restore a rendered file from the shared render cache if it is missing.
+
+    Returns True if the file is available.  Files in the cache are named by
+    the hashes of diagrams; they are hardlinked (or copied) into place.
+    """
+    if os.path.isfile(path):
+        return True
+
+    cachedir = get_cache_dir(builder)
+    if cachedir is None:
+        return False
+
+    cached = os.path.join(cachedir, os.path.basename(path))
+    try:
+        ensuredir(os.path.dirname(path))
+        try:
+            os.link(cached, path)
+        except FileExistsError:
+            pass  # restored by another process
+        except OSError:
+            if not os.path.isfile(cached):
+                return False
+            copy_atomically(cached, path)
+
+        os.utime(cached)  # mark as recently used; see evict_cache()
+    except OSError:
+        pass
+
+    return os.path.isfile(path)
+
+
+def store_in_cache(builder, path):
+    """Put a rendered file into the shared render cache."""
+    cachedir = get_cache_dir(builder)
+    if cachedir is None:
+        return
+
+    cached = os.path.join(cachedir, os.path.basename(path))
+    if not os.path.exists(cached):
+        try:
+            ensuredir(cachedir)
+            copy_atomically(path, cached)
+        except OSError as exc:
+            logger.warning('blockdiag: could not store %s to cache: %s', os.path.basename(path), exc)
+
+
+def copy_atomically(src, dest):
+    import shutil
+
+    with open(src, 'rb') as source, open_atomically(dest, 'wb') as fp:
+        shutil.copyfileobj(source, fp)
+
+
+@contextmanager
+def open_atomically(path, mode='w', **kwargs):
+    """Open a temporary file to write, and move it to *path* on success."""
+    tmppath = get_temp_path(path)
+    try:
+        with open(tmppath, mode, **kwargs) as fp:
+            yield fp
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def get_temp_path(path):
+    # unique in processes and threads; evict_cache() removes the ones left by crashed processes
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.tmp-%d-%d-%s' % (os.getpid(), threading.get_ident(), basename))
+
+
+def evict_cache(app):
+    """Remove least recently used files from the shared render cache to fit blockdiag_cache_size."""
+    rootdir = os.path.dirname(get_cache_dir(app.builder))
+    # the directory might be shared with others (ex. ~/.cache); touch only the files
+    # in the directories per version of blockdiag that look like written by us
+    pattern = re.compile(r'^(\.tmp-\d+-\d+-)?%s-[0-9a-f]{40}(-[0-9a-f]{40})?\.(png|pdf|svg)(\.json)?$' %
+                         blockdiag_node.name)
+    now = time.time()
+    files = []
+    for dirname in os.listdir(rootdir) if os.path.isdir(rootdir) else []:
+        root = os.path.join(rootdir, dirname)
+        if not re.match(r'^\d+(\.\d+)+\S*$', dirname) or not os.path.isdir(root):
+            continue
+
+        for filename in os.listdir(root):
+            if not pattern.match(filename):
+                continue
+
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+                if not filename.startswith('.tmp-'):
+                    files.append((stat.st_mtime, stat.st_size, path))
+                elif stat.st_mtime < now - 3600:
+                    os.remove(path)  # left by a crashed process
+            except OSError:
+                pass
+
+    size = sum(f[1] for f in files)
+    removed = 0
+    for _, filesize, path in sorted(files):
+        if size <= app.config.blockdiag_cache_size:
+            break
+
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        size -= filesize
+
+    if removed:
+        logger.info('blockdiag: %d files evicted from cache', removed)
 
 
 def html_render_svg(self, node):
-    image = node.to_drawer('SVG', self.builder, filename=None, nodoctype=True)
-    image.draw()
+    timings = {}
+    path = node.get_cachepath('SVG', self.builder)
+    embed_file = self.builder.config.blockdiag_html_svg_embed == 'file'
+    metadata = load_metadata(self.builder, path)
+    if metadata is None:
+        hrefs = None
+    else:
+        hrefs = [resolve_reference(self.builder, href, embed_file) for href in metadata['hrefs']]
+
+    if hrefs is None or not fetch_from_cache(self.builder, get_svg_cachepath(path, hrefs)):
+        if get_render_timeout(self.builder.config):
+            metadata, _, timings = call_with_watchdog(self.builder, path, render_svg,
+                                                      self.builder, node, path, hrefs, embed_file)
+            if hrefs is None:  # resolve them again; warnings in the process are dropped
+                hrefs = [resolve_reference(self.builder, href, embed_file) for href in metadata['hrefs']]
+        else:
+            metadata, hrefs, timings = render_svg(self.builder, node, path, hrefs, embed_file)
+
+        store_in_cache(self.builder, get_svg_cachepath(path, hrefs))
+        save_metadata(self.builder, path, metadata)
+
+    record_render(self.builder, self.builder.current_docname, path, metadata, timings, node.get('complexity'))
+    used_svg_files.add(get_svg_cachepath(path, hrefs))
 
     # align
     align = node['options'].get('align', 'default')
     self.body.append('<div class="align-%s">' % align)
     self.context.append('</div>\n')
 
-    # reftarget
-    for node_id in node['ids']:
-        self.body.append('<span id="%s"></span>' % node_id)
+    if embed_file:
+        publish_svg(get_svg_cachepath(path, hrefs), node.get_abspath('SVG', self.builder))
+
+        from blockdiag.utils import Size
+        size = Size(*metadata['size']).resize(**node['options'])
+        attrs = dict(width=size.width, height=size.height)
+        if any(hrefs):
+            # links in <img> are not clickable
+            attrs.update(data=node.get_relpath('SVG', self.builder), type='image/svg+xml')
+            self.body.append(self.starttag(node, 'object', '', **attrs))
+            self.body.append(self.encode(node['options'].get('alt', '')))
+            self.context.append('</object>')
+        else:
+            attrs.update(src=node.get_relpath('SVG', self.builder))
+            if 'alt' in node['options']:
+                attrs['alt'] = node['options']['alt']
+            self.body.append(self.starttag(node, 'img', '', empty=True, **attrs))
+            self.context.append('')
+    else:
+        # reftarget
+        for node_id in node['ids']:
+            self.body.append('<span id="%s"></span>' % node_id)
+
+        self.body.append(load_svg(self.builder, get_svg_cachepath(path, hrefs)))
+        self.context.append('')
+
+
+def render_svg(builder, node, path, hrefs, embed_file):
+    """Render an SVG image into the cache for the hrefs (resolved if None).
+
+    Returns the metadata, the hrefs and the timings of the image.
+    """
+    timings = {}
+    image = node.to_drawer('SVG', builder, filename=None, nodoctype=True,
+                           resolve_references=False, timings=timings)
+    metadata = get_metadata(image)
+    if hrefs is None:
+        hrefs = [resolve_reference(builder, href, embed_file) for href in metadata['hrefs']]
+    for diagram_node, href in zip(image.diagram.traverse_nodes(), hrefs):
+        diagram_node.href = href
+
+    with measure(timings, 'draw'):
+        image.draw()
+    with measure(timings, 'save'):
+        write_svg(image, image.pagesize().resize(**node['options']), get_svg_cachepath(path, hrefs),
+                  **get_svg_options(builder.config))
+
+    return metadata, hrefs, timings
+
+
+def publish_svg(svgpath, path):
+    """Copy a rendered SVG into the image directory (for blockdiag_html_svg_embed = 'file').
+
+    The file is left untouched if it is up to date, to keep the caches of
+    browsers and CDNs.
+    """
+    if registry.get(path) != svgpath:
+        if not os.path.exists(path) or not filecmp.cmp(svgpath, path, shallow=False):
+            copy_atomically(svgpath, path)
+        registry[path] = svgpath
+
+
+def get_metadata(image):
+    """Collect the page size, the clickable areas and the hrefs of an unresolved drawer."""
+    areas = []
+    for node in image.nodes:
+        if node.href:
+            areas.append(list(image.metrics.cell(node)) + [node.href])
+
+    NodeGroup = load_blockdiag().elements.NodeGroup
+    diagram_nodes = list(image.diagram.traverse_nodes())  # including groups
+    hrefs = [node.href for node in diagram_nodes]
+    return dict(size=list(image.pagesize()), areas=areas, hrefs=hrefs,
+                nodes=len([node for node in diagram_nodes if not isinstance(node, NodeGroup)]),
+                edges=len(list(image.diagram.traverse_edges())))
+
+
+def get_metadata_path(builder, path):
+    # keep sidecars out of outdir; some builders (ex. epub) package every file in it
+    filename = os.path.basename(path) + '.json'
+    return os.path.join(builder.doctreedir, 'blockdiag', filename)
+
+
+def load_metadata(builder, path):
+    metadata_path = get_metadata_path(builder, path)
+    if metadata_path not in registry:
+        metadata = metadata_index.get(os.path.basename(path))
+        if metadata is not None:
+            return metadata
+
+        fetch_from_cache(builder, metadata_path)
+        try:
+            with open(metadata_path, encoding='utf-8') as fp:
+                registry[metadata_path] = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    return registry[metadata_path]
+
 
-    # resize image
-    size = image.pagesize().resize(**node['options'])
-    self.body.append(image.save(size))
-    self.context.append('')
+def save_metadata(builder, path, metadata):
+    metadata_path = get_metadata_path(builder, path)
+    ensuredir(os.path.dirname(metadata_path))
+    with open_atomically(metadata_path, 'w', encoding='utf-8') as fp:
+        json.dump(metadata, fp)
 
+    registry[metadata_path] = metadata
+    store_in_cache(builder, metadata_path)
 
-def html_render_clickablemap(self, image, width_ratio, height_ratio):
-    href_nodes = [node for node in image.nodes if node.href]
-    if not href_nodes:
+
+def get_metadata_index_path(builder):
+    return os.path.join(builder.doctreedir, 'blockdiag', METADATA_INDEX)
+
+
+def load_metadata_index(builder):
+    metadata_index.clear()
+    try:
+        with open(get_metadata_index_path(builder), 'rb') as fp:
+            index = pickle.load(fp)
+        if index.get('version') == METADATA_INDEX_VERSION:
+            metadata_index.update(index['images'])
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        logger.debug('blockdiag: failed to load metadata index: %s', exc)
+
+
+def compact_metadata(builder):
+    """Merge sidecars written in this build into the metadata index.
+
+    Sidecars are written per image so that parallel writers (and the shared
+    cache) can exchange them; the next build loads all of them at once from
+    the index instead of opening a file per diagram.
+    """
+    dirname = os.path.dirname(get_metadata_index_path(builder))
+    if not os.path.isdir(dirname):
         return
 
-    self.body.append('<map name="map_%d">' % id(image))
-    for node in href_nodes:
-        x1, y1, x2, y2 = image.metrics.cell(node)
+    pattern = re.compile(r'^(%s-[0-9a-f]{40}\.(png|pdf|svg))\.json$' % blockdiag_node.name)
+    sidecars = []
+    for filename in os.listdir(dirname):
+        matched = pattern.match(filename)
+        if matched:
+            path = os.path.join(dirname, filename)
+            try:
+                with open(path, encoding='utf-8') as fp:
+                    metadata_index[matched.group(1)] = json.load(fp)
+                sidecars.append(path)
+            except (OSError, ValueError):
+                pass  # written by another process right now; merged by it
+
+    index = dict(version=METADATA_INDEX_VERSION, images=metadata_index)
+    with open_atomically(get_metadata_index_path(builder), 'wb') as fp:
+        pickle.dump(index, fp, pickle.HIGHEST_PROTOCOL)
+
+    for path in sidecars:
+        os.remove(path)
+
+
+def html_render_clickablemap(self, node, areas, width_ratio, height_ratio):
+    if not areas:
+        return
 
+    self.body.append('<map name="map_%d">' % id(node))
+    for x1, y1, x2, y2, href in areas:
         x1 *= width_ratio
         x2 *= width_ratio
         y1 *= height_ratio
         y2 *= height_ratio
-        areatag = '<area shape="rect" coords="%s,%s,%s,%s" href="%s">' % (x1, y1, x2, y2, node.href)
+        areatag = '<area shape="rect" coords="%s,%s,%s,%s" href="%s">' % (x1, y1, x2, y2, href)
         self.body.append(areatag)
 
     self.body.append('</map>')
 
 
 def html_render_png(self, node):
-    image = node.to_drawer('PNG', self.builder)
-    if not os.path.isfile(image.filename):
-        image.draw()
-        image.save()
+    timings = {}
+    deferred = False
+    path = node.get_abspath('PNG', self.builder)
+    metadata = load_metadata(self.builder, path)
+    rendered = fetch_from_cache(self.builder, path)
+    if (metadata is None or not rendered) and path not in deferred_renders:
+        lockpath = get_lock_path(self.builder, path)
+        filename = None if rendered else acquire_render(path, lockpath)
+        if filename is not None and get_render_timeout(self.builder.config):
+            # hrefs are stored unresolved; they are resolved per document below
+            metadata, timings = render_isolated(self.builder, node, 'PNG', path, filename,
+                                                resolve_references=False)
+            save_metadata(self.builder, path, metadata)
+            store_in_cache(self.builder, path)
+        else:
+            try:
+                image = node.to_drawer('PNG', self.builder, filename=filename or path, resolve_references=False,
+                                       timings=timings)
+            except BaseException:
+                if filename:
+                    abort_render(filename, lockpath)
+                raise
+
+            metadata = get_metadata(image)
+            save_metadata(self.builder, path, metadata)
+
+            if filename is not None:  # None if rendered by another worker
+                if is_deferrable(self.builder, image):
+                    defer_render(self.builder, self.builder.current_docname, node, path, image, timings)
+                    deferred = True
+                else:
+                    draw_image(self.builder, image, path, timings)
+                    store_in_cache(self.builder, path)
+
+    if not deferred:
+        record_render(self.builder, self.builder.current_docname, path, metadata, timings, node.get('complexity'))
 
     # align
     align = node['options'].get('align', 'default')
@@ -163,18 +1044,25 @@ def html_render_png(self, node):
         self.context.append('')
 
     # <img> tag
-    original_size = image.pagesize()
+    from blockdiag.utils import Size
+    original_size = Size(*metadata['size'])
     resized = original_size.resize(**node['options'])
     img_attr = dict(src=relpath,
                     width=resized.width,
                     height=resized.height)
 
-    if any(node.href for node in image.nodes):
-        img_attr['usemap'] = "#map_%d" % id(image)
+    areas = []
+    for area in metadata['areas']:
+        href = resolve_reference(self.builder, area[-1])
+        if href:
+            areas.append(area[:-1] + [href])
+
+    if areas:
+        img_attr['usemap'] = "#map_%d" % id(node)
 
         width_ratio = float(resized.width) / original_size.width
         height_ratio = float(resized.height) / original_size.height
-        html_render_clickablemap(self, image, width_ratio, height_ratio)
+        html_render_clickablemap(self, node, areas, width_ratio, height_ratio)
 
     if 'alt' in node['options']:
         img_attr['alt'] = node['options']['alt']
@@ -182,14 +1070,70 @@ def html_render_png(self, node):
     self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
 
 
-@with_blockdiag
+# builders not packaging outdir on finish(); the deferred renders are drained
+# on `build-finished` event which is emitted after that.
+DEFERRABLE_BUILDERS = ('html', 'dirhtml', 'singlehtml')
+
+
+def is_deferrable(builder, image):
+    if not builder.config.blockdiag_html_deferred_render:
+        return False
+    elif get_render_timeout(builder.config):
+        return False  # renders are isolated into processes
+    elif builder.app.parallel > 1:
+        return False  # parallel writers exit without waiting the queue
+    elif builder.name not in DEFERRABLE_BUILDERS:
+        return False  # others (ex. epub) package outdir on finish(); before the queue is drained
+    else:
+        # images fetched by blockdiag are removed on leaving html_visit_blockdiag()
+        return not any(getattr(node, 'icon', None) or getattr(node, 'background', None)
+                       for node in image.diagram.traverse_nodes())
+
+
+def defer_render(builder, docname, node, path, image, timings):
+    """Draw and save a PNG image in background; see flush_deferred_renders()."""
+    global render_executor
+    if render_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        render_executor = ThreadPoolExecutor(get_concurrency(builder.config.blockdiag_render_threads) or 1)
+
+    future = render_executor.submit(draw_image, builder, image, path, timings)
+    deferred_renders[path] = (docname, node['code'], node.get('complexity'), timings, future)
+
+
+def flush_deferred_renders(builder):
+    """Wait for the images drawn in background, and record them."""
+    global render_executor
+    if render_executor is None:
+        return
+
+    render_executor.shutdown(wait=True)
+    render_executor = None
+
+    for path, (docname, code, complexity, timings, future) in sorted(deferred_renders.items()):
+        try:
+            metadata = future.result()
+            store_in_cache(builder, path)
+            record_render(builder, docname, path, metadata, timings, complexity)
+        except Exception as exc:
+            if builder.config.blockdiag_debug:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+            logger.warning('dot code %r: %s', code, exc)
+
+    deferred_renders.clear()
+
+
 def html_visit_blockdiag(self, node):
+    from blockdiag.utils.bootstrap import Application
+
     try:
-        image_format = get_image_format_for(self.builder)
-        if image_format.upper() == 'SVG':
-            html_render_svg(self, node)
-        else:
-            html_render_png(self, node)
+        with Application():
+            image_format = get_image_format_for(self.builder)
+            if image_format.upper() == 'SVG':
+                html_render_svg(self, node)
+            else:
+                html_render_png(self, node)
     except UnicodeEncodeError:
         if self.builder.config.blockdiag_debug:
             traceback.print_exc()
@@ -234,37 +1178,315 @@ def get_image_format_for(builder):
     return image_format
 
 
+def embeds_images(builder):
+    support = dict(BUILDER_IMAGE_SUPPORT, **(builder.config.blockdiag_builder_images or {}))
+    return support.get(builder.name, True)
+
+
 def on_builder_inited(self):
     # show deprecated message
     if self.builder.config.blockdiag_tex_image_format:
         logger.warning('blockdiag_tex_image_format is deprecated. Use blockdiag_latex_image_format.')
 
-    # initialize fontmap
     global fontmap
+    fontmap = None  # configuration might be changed
+    loaded_fonts.clear()  # font files might be changed
+
+    registry.clear()
+    resolved_references.clear()
+    render_settings.clear()
+    ensured_dirs.clear()
+    timed_out_renders.clear()
+    load_metadata_index(self.builder)
+
+    global main_pid, counts_pid
+    main_pid = counts_pid = os.getpid()
+    collect_records(self.builder)  # discard records of an aborted build
+    collect_render_counts(self.builder)
+
+
+def get_fontmap(config):
+    if fontmap is None:
+        for error in setup_fontmap(config.blockdiag_fontmap, config.blockdiag_fontpath):
+            logger.warning('blockdiag error: %s', error)
+
+    return fontmap
+
+
+def get_fontmap_key(fontmappath, fontpath):
+    from blockdiag.utils.fontmap import parse_fontpath
+
+    key = []
+    for path in [fontmappath] + list(fontpath or []):
+        try:
+            mtime = os.stat(parse_fontpath(path)[0]).st_mtime
+        except (OSError, TypeError):
+            mtime = None
+        key.append((path, mtime))
+
+    return tuple(key)
+
+
+def setup_fontmap(fontmappath, fontpath):
+    """Initialize fontmap; returns the errors found on resolving fonts.
+
+    The resolved fontmaps are cached while the font settings and the files
+    are not changed.
+    """
+    global fontmap
+    from blockdiag.utils.bootstrap import detectfont
+    from blockdiag.utils.fontmap import FontMap
+
+    if isinstance(fontpath, str):
+        fontpath = [fontpath]
+
+    key = get_fontmap_key(fontmappath, fontpath)
+    if key not in fontmaps:
+        errors = []
+        try:
+            resolved = FontMap(fontmappath)
+        except Exception as exc:
+            errors.append(str(exc))
+            resolved = FontMap(None)
+
+        try:
+            if fontpath:
+                config = namedtuple('Config', 'font')(fontpath)
+                resolved.set_default_font(detectfont(config))
+        except Exception as exc:
+            errors.append(str(exc))
+
+        fontmaps[key] = (resolved, errors)
+        setup_font_caches()
+
+    fontmap, errors = fontmaps[key]
+    return errors
+
+
+def setup_font_caches():
+    """Share font objects and text metrics between diagrams.
+
+    blockdiag loads a TrueType file on each text measurement (PNG) and for
+    each diagram (PDF), and memoizes text metrics per image; these are
+    replaced by caches shared in the process.
+    """
+    from blockdiag.imagedraw import png
+
+    if not hasattr(png.ttfont_for, 'loader'):
+        png.ttfont_for = shared_font_loader(png.ttfont_for, lambda font: ('PNG', font.path, font.size))
+    cache_text_metrics(png.ImageDrawExBase, 'PNG')
 
     try:
-        fontmappath = self.builder.config.blockdiag_fontmap
-        fontmap = FontMap(fontmappath)
+        from blockdiag.imagedraw import pdf
+    except ImportError:
+        return  # reportlab is not installed
+
+    if not hasattr(pdf.TTFont, 'loader'):
+        pdf.TTFont = shared_font_loader(pdf.TTFont, lambda *args, **kwargs: ('PDF', args, kwargs.get('subfontIndex')))
+    cache_text_metrics(pdf.PDFImageDraw, 'PDF')
+
+
+def shared_font_loader(loader, keyfunc):
+    def load(*args, **kwargs):
+        key = keyfunc(*args, **kwargs)
+        if key not in loaded_fonts:
+            loaded_fonts[key] = loader(*args, **kwargs)
+
+        return loaded_fonts[key]
+
+    load.loader = loader
+    return load
+
+
+def cache_text_metrics(drawer_class, image_format):
+    textlinesize = drawer_class.textlinesize
+    if hasattr(textlinesize, 'measure'):
+        return
+
+    measure_text = getattr(textlinesize, '__wrapped__', textlinesize)  # bypass the memoize of blockdiag
+
+    def cached_textlinesize(self, string, font, **kwargs):
+        key = (image_format, font.path, font.size, string)
+        with text_metrics_lock:
+            size = text_metrics.get(key)
+            if size is not None:
+                text_metrics.move_to_end(key)
+
+        if size is None:
+            text_metrics_stats.misses = getattr(text_metrics_stats, 'misses', 0) + 1
+            size = measure_text(self, string, font, **kwargs)
+            with text_metrics_lock:
+                text_metrics[key] = size
+                if len(text_metrics) > TEXT_METRICS_CACHE_SIZE:
+                    text_metrics.popitem(last=False)
+        else:
+            text_metrics_stats.hits = getattr(text_metrics_stats, 'hits', 0) + 1
+
+        return size
+
+    cached_textlinesize.measure = measure_text
+    drawer_class.textlinesize = cached_textlinesize
+
+
+def get_concurrency(value):
+    if value == 'auto':
+        return os.cpu_count() or 1
+    else:
+        return int(value or 0)
+
+
+def prerender_image(image_format, code, options, path, lockpath, kwargs, svg_options=None, timeout=None):
+    """Render a diagram in a worker process of on_env_updated().
+
+    Failures are ignored here; such diagrams are rendered again in the
+    write phase, which emits the usual warnings.  Returns False if the
+    rendering exceeds *timeout* seconds.
+    """
+    filename = None
+    try:
+        if image_format != 'SVG':
+            filename = acquire_render(path, lockpath)
+            if filename is None:
+                return None  # rendered by another process
+
+        if timeout:
+            result = call_with_timeout(timeout, render_in_worker, image_format, code, options, path, filename,
+                                       kwargs, svg_options)
+        else:
+            result = render_in_worker(image_format, code, options, path, filename, kwargs, svg_options)
+
+        if filename:
+            commit_render(filename, path, lockpath)
+        return result
+    except RenderTimeout as exc:
+        if filename:
+            abort_render(filename, lockpath)
+        remove_temp_files(os.path.dirname(path), exc.pid)
+        return False
     except Exception:
-        fontmap = FontMap(None)
+        if filename:
+            abort_render(filename, lockpath)
+        return None
+
+
+def render_in_worker(image_format, code, options, path, filename, kwargs, svg_options):
+    """Render a diagram into *filename* (or the SVG cache) for prerender_image().
+
+    Returns the metadata, the rendered file (None if not rendered) and the
+    timings.
+    """
+    from blockdiag.utils.bootstrap import Application
+
+    node = blockdiag_node(code=code, options=options)
+    timings = {}
+    with Application():
+        diagram = node.to_diagram(timings)
+        with measure(timings, 'layout'):
+            if image_format == 'SVG':
+                image = node.processor.drawer.DiagramDraw(image_format, diagram, None, fontmap=fontmap,
+                                                          nodoctype=True, **kwargs)
+            else:
+                image = node.processor.drawer.DiagramDraw(image_format, diagram, filename, fontmap=fontmap,
+                                                          **kwargs)
+        metadata = get_metadata(image)
+
+        with measure(timings, 'draw'):
+            image.draw()
+        with measure(timings, 'save'):
+            if image_format == 'SVG':
+                if any(href and href.startswith(':ref:') for href in metadata['hrefs']):
+                    # :ref: hrefs are resolved for each document in the write phase
+                    rendered = None
+                else:
+                    rendered = get_svg_cachepath(path, metadata['hrefs'])
+                    write_svg(image, image.pagesize().resize(**options), rendered, **(svg_options or {}))
+            else:
+                image.save()
+                rendered = path
+
+        return metadata, rendered, timings
+
+
+def is_rendered(builder, image_format, path):
+    if load_metadata(builder, path) is None:
+        return False
+    elif image_format == 'SVG':
+        return True
+    else:
+        return fetch_from_cache(builder, path)
+
+
+def on_env_updated(app, env):
+    resolved_references.clear()  # labels might be changed
+    ensured_dirs.clear()  # directories might be removed since the last build
+
+    workers = get_concurrency(app.config.blockdiag_render_workers)
+    if (app.parallel > 1 or workers > 0) and getattr(env, 'blockdiag_diagrams', None):
+        get_fontmap(app.config)  # resolve fonts once; forked processes inherit them
+
+    if workers <= 0 or not embeds_images(app.builder):
+        return
 
     try:
-        fontpath = self.builder.config.blockdiag_fontpath
-        if isinstance(fontpath, str):
-            fontpath = [fontpath]
-
-        if fontpath:
-            config = namedtuple('Config', 'font')(fontpath)
-            fontpath = detectfont(config)
-            fontmap.set_default_font(fontpath)
+        image_format = get_image_format_for(app.builder).upper()
     except Exception:
-        pass
+        return  # the error is reported in the write phase
+
+    kwargs = dict(antialias=app.config.blockdiag_antialias,
+                  transparency=app.config.blockdiag_transparency)
+    jobs = {}
+    for docname, diagrams in sorted(getattr(env, 'blockdiag_diagrams', {}).items()):
+        for _, code, options, _ in diagrams:
+            node = blockdiag_node(code=code, options=options)
+            if image_format == 'SVG':
+                path = node.get_cachepath(image_format, app.builder)
+            else:
+                path = node.get_abspath(image_format, app.builder)
+
+            if path not in jobs and not is_rendered(app.builder, image_format, path):
+                lockpath = get_lock_path(app.builder, path)
+                jobs[path] = (docname, (image_format, node['code'], node['options'], path, lockpath, kwargs,
+                                        get_svg_options(app.config), get_render_timeout(app.config)))
+
+    if not jobs:
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    logger.info('blockdiag: rendering %d diagrams with %d workers', len(jobs), workers)
+    initargs = (app.config.blockdiag_fontmap, app.config.blockdiag_fontpath)
+    with ProcessPoolExecutor(workers, initializer=setup_fontmap, initargs=initargs) as executor:
+        futures = {path: executor.submit(prerender_image, *job) for path, (_, job) in jobs.items()}
+        for path, future in futures.items():
+            result = future.result()
+            if result is False:
+                timed_out_renders.add(path)  # not to wait for it again in the write phase
+                continue
+            elif result is None:
+                continue
+
+            metadata, rendered, timings = result
+            if rendered is not None:
+                store_in_cache(app.builder, rendered)
+            save_metadata(app.builder, path, metadata)
+            prerendered_images[path] = timings
 
 
 def on_doctree_resolved(self, doctree, docname):
     if self.builder.format in ('html', 'slides'):
         return
 
+    diagrams = list(doctree.traverse(blockdiag_node))
+    if not diagrams:
+        return
+
+    if not embeds_images(self.builder):
+        # the builder shows the alt text at most (ex. "[image: alt]" in text)
+        for node in diagrams:
+            filename = node.get_filename('PNG', self.builder)
+            node.parent.replace(node, nodes.image(uri=filename, **node['options']))
+        return
+
     try:
         image_format = get_image_format_for(self.builder)
     except Exception as exc:
@@ -272,22 +1494,32 @@ def on_doctree_resolved(self, doctree, docname):
             traceback.print_exc()
 
         logger.warning('blockdiag error: %s', exc)
-        for node in doctree.traverse(blockdiag_node):
+        for node in diagrams:
             node.parent.remove(node)
 
         return
 
-    for node in doctree.traverse(blockdiag_node):
+    threads = get_concurrency(self.builder.config.blockdiag_render_threads)
+    if threads > 1 and len(diagrams) > 1 and not get_render_timeout(self.builder.config):
+        results = render_images_concurrently(self.builder, diagrams, image_format, threads)
+    else:
+        results = render_images(self.builder, diagrams, image_format)
+
+    for node, (metadata, timings, error) in zip(diagrams, results):
         try:
-            with Application():
-                relfn = node.get_relpath(image_format, self.builder)
-                image = node.to_drawer(image_format, self.builder)
-                if not os.path.isfile(image.filename):
-                    image.draw()
-                    image.save()
-
-                image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
-                node.parent.replace(node, image)
+            if error is not None:
+                raise error
+
+            relfn = node.get_relpath(image_format, self.builder)
+            path = node.get_abspath(image_format, self.builder)
+            if metadata is not None:
+                save_metadata(self.builder, path, metadata)
+                store_in_cache(self.builder, path)
+
+            record_render(self.builder, docname, path, metadata, timings, node.get('complexity'))
+
+            image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
+            node.parent.replace(node, image)
         except Exception as exc:
             if self.builder.config.blockdiag_debug:
                 traceback.print_exc()
@@ -296,7 +1528,588 @@ def on_doctree_resolved(self, doctree, docname):
             node.parent.remove(node)
 
 
+def layout_image(builder, node, image_format, timings):
+    path = node.get_abspath(image_format, builder)
+    if fetch_from_cache(builder, path):
+        return None  # already rendered
+
+    lockpath = get_lock_path(builder, path)
+    filename = acquire_render(path, lockpath)
+    if filename is None:
+        return None  # rendered by another worker
+
+    try:
+        return node.to_drawer(image_format, builder, filename=filename, timings=timings)
+    except BaseException:
+        abort_render(filename, lockpath)
+        raise
+
+
+def draw_image(builder, image, path, timings):
+    """Draw and save an image laid out into a temporary file, then move it to *path*."""
+    if image is None:
+        return None
+
+    lockpath = get_lock_path(builder, path)
+    try:
+        with measure(timings, 'draw'):
+            image.draw()
+        with measure(timings, 'save'):
+            image.save()
+    except BaseException:
+        abort_render(image.filename, lockpath)
+        raise
+
+    commit_render(image.filename, path, lockpath)
+    return get_metadata(image)
+
+
+def render_image_with_watchdog(builder, node, image_format, timings):
+    """Do layout_image() and draw_image() in a process under the watchdog."""
+    path = node.get_abspath(image_format, builder)
+    if fetch_from_cache(builder, path):
+        return None  # already rendered
+
+    filename = acquire_render(path, get_lock_path(builder, path))
+    if filename is None:
+        return None  # rendered by another worker
+
+    metadata, rendered_timings = render_isolated(builder, node, image_format, path, filename)
+    timings.update(rendered_timings)
+    return metadata
+
+
+def render_isolated(builder, node, image_format, path, filename, **kwargs):
+    """Render an image into *filename* under the watchdog, then move it to *path*.
+
+    The lock for *path* must have been acquired.  Returns the metadata and
+    the timings of the image.
+    """
+    lockpath = get_lock_path(builder, path)
+    try:
+        metadata, timings = call_with_watchdog(builder, path, render_image,
+                                               builder, node, image_format, filename, **kwargs)
+    except BaseException:
+        abort_render(filename, lockpath)
+        raise
+
+    commit_render(filename, path, lockpath)
+    return metadata, timings
+
+
+def render_image(builder, node, image_format, filename, **kwargs):
+    timings = {}
+    image = node.to_drawer(image_format, builder, filename=filename, timings=timings, **kwargs)
+    with measure(timings, 'draw'):
+        image.draw()
+    with measure(timings, 'save'):
+        image.save()
+
+    return get_metadata(image), timings
+
+
+def get_render_timeout(config):
+    """Return blockdiag_render_timeout in seconds (None: disabled or not supported)."""
+    import multiprocessing
+
+    if config.blockdiag_render_timeout and 'fork' in multiprocessing.get_all_start_methods():
+        return float(config.blockdiag_render_timeout)
+    else:
+        return None
+
+
+class RenderTimeout(Exception):
+    def __init__(self, timeout, pid=None):
+        super(RenderTimeout, self).__init__('rendering took longer than %s seconds' % timeout)
+        self.pid = pid
+
+
+def call_with_watchdog(builder, path, func, *args, **kwargs):
+    """Call *func* in a process killed after blockdiag_render_timeout seconds.
+
+    A diagram timed out once fails immediately in the rest of the build.
+    """
+    timeout = get_render_timeout(builder.config)
+    if path in timed_out_renders:
+        raise RenderTimeout(timeout)
+
+    get_fontmap(builder.config)  # resolve fonts here; the process inherits them
+    try:
+        return call_with_timeout(timeout, func, *args, **kwargs)
+    except RenderTimeout as exc:
+        timed_out_renders.add(path)
+        remove_temp_files(os.path.dirname(path), exc.pid)
+        raise
+
+
+def call_with_timeout(timeout, func, *args, **kwargs):
+    """Call *func* in a forked process and return its result.
+
+    The process is killed if it does not finish in *timeout* seconds.
+    Exceptions are raised again in the caller; the logs of the process are
+    dropped.
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context('fork')
+    reader, writer = context.Pipe(duplex=False)
+
+    def run():
+        try:
+            with logging.suppress_logging():
+                result = (True, func(*args, **kwargs))
+        except BaseException as exc:
+            result = (False, exc)
+
+        try:
+            writer.send(result)
+        except Exception:  # not picklable
+            writer.send((False, RuntimeError(str(result[1]))))
+
+    process = context.Process(target=run)
+    process.start()
+    writer.close()
+    try:
+        if not reader.poll(timeout):
+            process.kill()
+            raise RenderTimeout(timeout, process.pid)
+
+        succeeded, result = reader.recv()
+    except EOFError:
+        raise RuntimeError('rendering process exited unexpectedly')
+    finally:
+        process.join()
+        reader.close()
+
+    if succeeded:
+        return result
+    else:
+        raise result
+
+
+def remove_temp_files(dirname, pid):
+    """Remove files left by open_atomically() in a killed process."""
+    prefix = '.tmp-%d-' % pid
+    try:
+        for filename in os.listdir(dirname):
+            if filename.startswith(prefix):
+                os.remove(os.path.join(dirname, filename))
+    except OSError:
+        pass
+
+
+def get_lock_path(builder, path):
+    return os.path.join(builder.doctreedir, 'blockdiag', os.path.basename(path) + '.lock')
+
+
+def acquire_render(path, lockpath):
+    """Take the lock to render an image.
+
+    Returns a temporary filename to render the image into; it is moved to
+    *path* by commit_render().  If other process is rendering the image, this
+    waits for it.  Returns None if the image has been rendered meanwhile, or
+    is being rendered in this process.
+    """
+    ensuredir(os.path.dirname(lockpath))
+    deadline = time.time() + LOCK_TIMEOUT
+    while not os.path.isfile(path):
+        with held_locks_mutex:
+            if held_locks.get(lockpath) == os.getpid():
+                return None
+
+            try:
+                fd = os.open(lockpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                held_locks[lockpath] = os.getpid()
+            except FileExistsError:
+                fd = None
+
+        if fd is None:
+            owner = get_lock_owner(lockpath)
+            if owner is False or owner == os.getpid() or time.time() > deadline:
+                release_lock(lockpath)  # stale lock
+            else:
+                time.sleep(0.05)
+            continue
+
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(str(os.getpid()))
+
+        ensuredir(os.path.dirname(path))
+        return get_temp_path(path)
+
+    return None
+
+
+def get_lock_owner(lockpath):
+    """Returns the pid holding the lock; False if the process has gone, None if unknown."""
+    try:
+        with open(lockpath) as fp:
+            pid = int(fp.read())
+    except (OSError, ValueError):
+        return None  # released or being written
+
+    if os.name == 'posix':
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+
+    return pid
+
+
+def commit_render(filename, path, lockpath):
+    try:
+        os.replace(filename, path)
+    finally:
+        release_lock(lockpath)
+
+
+def abort_render(filename, lockpath):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    finally:
+        release_lock(lockpath)
+
+
+def release_lock(lockpath):
+    with held_locks_mutex:
+        try:
+            os.remove(lockpath)
+        except OSError:
+            pass
+        held_locks.pop(lockpath, None)
+
+
+def render_images(builder, diagrams, image_format):
+    """Render diagrams for non-HTML builders one by one.
+
+    Yields ``(metadata, timings, error)`` for each diagram; metadata is None
+    if the image has been rendered already.
+    """
+    from blockdiag.utils.bootstrap import Application
+
+    for node in diagrams:
+        timings = {}
+        try:
+            with Application():
+                if get_render_timeout(builder.config):
+                    metadata = render_image_with_watchdog(builder, node, image_format, timings)
+                else:
+                    image = layout_image(builder, node, image_format, timings)
+                    metadata = draw_image(builder, image, node.get_abspath(image_format, builder), timings)
+        except Exception as exc:
+            yield None, timings, exc
+        else:
+            yield metadata, timings, None
+
+
+def render_images_concurrently(builder, diagrams, image_format, threads):
+    """Render diagrams for non-HTML builders with a thread pool.
+
+    The diagrams are laid out one by one because blockdiag keeps plugins in
+    global state; then they are drawn and saved concurrently.  The results
+    are yielded in document order like render_images().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from blockdiag.utils.bootstrap import Application
+
+    layouts = []
+    for node in diagrams:
+        timings = {}
+        try:
+            with Application():
+                layouts.append((layout_image(builder, node, image_format, timings), timings, None))
+        except Exception as exc:
+            layouts.append((None, timings, exc))
+
+    with Application(), ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(draw_image, builder, image, node.get_abspath(image_format, builder), timings)
+                   for node, (image, timings, _) in zip(diagrams, layouts)]
+        for (_, timings, error), future in zip(layouts, futures):
+            metadata = None
+            if error is None:
+                try:
+                    metadata = future.result()
+                except Exception as exc:
+                    error = exc
+
+            yield metadata, timings, error
+
+
+def on_doctree_read(app, doctree):
+    env = app.env
+    if not hasattr(env, 'blockdiag_diagrams'):
+        env.blockdiag_diagrams = {}
+
+    diagrams = [(node['digest'], node['code'], node['options'], node.get('complexity'))
+                for node in doctree.traverse(blockdiag_node)]
+    if diagrams and embeds_images(app.builder):
+        try:
+            image_format = get_image_format_for(app.builder).upper()
+        except Exception:
+            image_format = None  # reported in the write phase
+
+        if image_format:
+            # hash the images here; documents are read in parallel
+            for node in doctree.traverse(blockdiag_node):
+                node.describe(image_format, app.builder)
+
+    if diagrams:
+        env.blockdiag_diagrams[env.docname] = diagrams
+    else:
+        env.blockdiag_diagrams.pop(env.docname, None)
+
+
+def on_env_before_read_docs(app, env, docnames):
+    parsed_diagrams.clear()
+    for diagrams in getattr(env, 'blockdiag_diagrams', {}).values():
+        for digest, code, _, complexity in diagrams:
+            parsed_diagrams[digest] = (code, complexity)
+
+
+def on_env_purge_doc(app, env, docname):
+    if hasattr(env, 'blockdiag_diagrams'):
+        env.blockdiag_diagrams.pop(docname, None)
+
+
+def on_env_merge_info(app, env, docnames, other):
+    if not hasattr(env, 'blockdiag_diagrams'):
+        env.blockdiag_diagrams = {}
+
+    for docname in docnames:
+        if docname in getattr(other, 'blockdiag_diagrams', {}):
+            env.blockdiag_diagrams[docname] = other.blockdiag_diagrams[docname]
+
+
+def get_referenced_images(builder, image_format):
+    """Return the filenames of images referred from the documents.
+
+    The names are computed from the current configuration; they would be
+    out of date if they were hashed at reading time.
+    """
+    filenames = set()
+    for diagrams in getattr(builder.env, 'blockdiag_diagrams', {}).values():
+        for _, code, options, _ in diagrams:
+            node = blockdiag_node(code=code, options=options)
+            filenames.add(node.get_filename(image_format, builder))
+
+    return filenames
+
+
+def prune_images(app):
+    if not embeds_images(app.builder):
+        return
+
+    try:
+        image_format = get_image_format_for(app.builder)
+    except Exception:
+        return  # already reported in the write phase
+
+    referenced = get_referenced_images(app.builder, image_format)
+    orphans = []
+
+    imagedir = os.path.join(app.builder.outdir, app.builder.imagedir)
+    if os.path.isdir(imagedir):
+        pattern = re.compile(r'^%s-[0-9a-f]{40}\.(png|pdf|svg)$' % blockdiag_node.name)
+        orphans += [os.path.join(imagedir, filename) for filename in sorted(os.listdir(imagedir))
+                    if pattern.match(filename) and filename not in referenced]
+
+    # SVG images are cached per set of resolved hrefs (see get_svg_cachepath());
+    # the sets not used in this build are out of date if the diagram has been written
+    cachedir = os.path.join(app.builder.doctreedir, 'blockdiag')
+    if image_format.upper() == 'SVG' and os.path.isdir(cachedir):
+        pattern = re.compile(r'^(%s-[0-9a-f]{40})-[0-9a-f]{40}\.svg$' % blockdiag_node.name)
+        used = set(os.path.basename(path) for path in used_svg_files)
+        written = set(pattern.match(filename).group(1) for filename in used)
+        for filename in sorted(os.listdir(cachedir)):
+            matched = pattern.match(filename)
+            if matched is None:
+                continue
+            elif matched.group(1) + '.svg' not in referenced:
+                orphans.append(os.path.join(cachedir, filename))
+            elif matched.group(1) in written and filename not in used:
+                orphans.append(os.path.join(cachedir, filename))
+
+    dry_run = app.config.blockdiag_prune_images == 'dry-run'
+    for path in orphans:
+        if dry_run:
+            logger.info('blockdiag: unreferenced image: %s', path)
+        else:
+            os.remove(path)
+            metadata_index.pop(os.path.basename(path), None)
+            metadata_path = get_metadata_path(app.builder, path)
+            if os.path.exists(metadata_path):
+                os.remove(metadata_path)
+
+    if dry_run:
+        logger.info('blockdiag: %d unreferenced images found', len(orphans))
+        return
+    elif orphans:
+        logger.info('blockdiag: %d unreferenced images removed', len(orphans))
+
+    # metadata of the unreferenced images (including the ones not in imagedir; ex. SVG)
+    extension = '.' + image_format.lower()
+    for filename in list(metadata_index):
+        if filename.endswith(extension) and filename not in referenced:
+            del metadata_index[filename]
+
+
+def get_report_dir(builder):
+    return os.path.join(builder.doctreedir, 'blockdiag', 'report')
+
+
+def record_render(builder, docname, path, metadata, timings, complexity=None):
+    """Record the cost of a diagram for the build-end report.
+
+    *complexity* is the one measured on reading (see measure_complexity());
+    its estimated cost is reported as is.
+
+    Only the numbers of reused and regenerated diagrams are counted unless
+    blockdiag_render_report is enabled.  Records are appended to a file per
+    process so that diagrams rendered by parallel writers are also counted.
+    """
+    if not timings and path in prerendered_images:
+        timings = prerendered_images.pop(path)  # the first use of the image rendered by workers
+
+    global counts_pid
+    if counts_pid != os.getpid():
+        # counts of the main process are inherited on forking a parallel writer
+        counts_pid = os.getpid()
+        render_counts.update(reused=0, regenerated=0)
+
+    render_counts['regenerated' if timings else 'reused'] += 1
+    if not builder.config.blockdiag_render_report:
+        return
+
+    if metadata is None:
+        metadata = load_metadata(builder, path)
+
+    metadata = metadata or {}
+
+    record = dict(docname=docname,
+                  image=os.path.basename(path),
+                  cached=not timings,
+                  nodes=metadata.get('nodes'),
+                  edges=metadata.get('edges'),
+                  cost=complexity['cost'] if complexity else None,
+                  total=sum(timings.get(name, 0) for name in PHASES),
+                  text_metrics_hits=timings.get('text_metrics_hits', 0),
+                  text_metrics_misses=timings.get('text_metrics_misses', 0))
+    for name in PHASES:
+        record[name] = timings.get(name, 0)
+
+    reportdir = get_report_dir(builder)
+    ensuredir(reportdir)
+    with open(os.path.join(reportdir, '%d.jsonl' % os.getpid()), 'a', encoding='utf-8') as fp:
+        fp.write(json.dumps(record) + '\n')
+
+
+def collect_records(builder, extension='.jsonl'):
+    records = []
+    reportdir = get_report_dir(builder)
+    if os.path.isdir(reportdir):
+        for filename in sorted(os.listdir(reportdir)):
+            if filename.endswith(extension):
+                path = os.path.join(reportdir, filename)
+                with open(path, encoding='utf-8') as fp:
+                    records.extend(json.loads(line) for line in fp if line.strip())
+                os.remove(path)
+
+    return records
+
+
+def on_html_page_context(app, pagename, templatename, context, doctree):
+    if main_pid != counts_pid == os.getpid() and any(render_counts.values()):
+        # a parallel writer; pass the counts to the main process through a file
+        reportdir = get_report_dir(app.builder)
+        ensuredir(reportdir)
+        with open(os.path.join(reportdir, '%d.counts' % os.getpid()), 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(render_counts) + '\n')
+        render_counts.update(reused=0, regenerated=0)
+
+
+def collect_render_counts(builder):
+    """Return the numbers of diagrams reused and regenerated, and reset them."""
+    counts = [render_counts] + collect_records(builder, '.counts')
+    reused = sum(c['reused'] for c in counts)
+    regenerated = sum(c['regenerated'] for c in counts)
+    render_counts.update(reused=0, regenerated=0)
+
+    return reused, regenerated
+
+
+def write_report(app, records):
+    documents = {}
+    for record in records:
+        document = documents.setdefault(record['docname'], dict(diagrams=0, total=0))
+        document['diagrams'] += 1
+        document['total'] += record['total']
+
+    hits = sum(r.get('text_metrics_hits', 0) for r in records)
+    misses = sum(r.get('text_metrics_misses', 0) for r in records)
+    text_metrics = dict(hits=hits, misses=misses, hit_rate=float(hits) / (hits + misses) if hits + misses else 0)
+
+    limit = app.config.blockdiag_render_report_limit
+    slowest = sorted((r for r in records if not r['cached']), key=lambda r: r['total'], reverse=True)[:limit]
+    report = dict(diagrams=len(records),
+                  cache_hits=len([r for r in records if r['cached']]),
+                  cache_misses=len([r for r in records if not r['cached']]),
+                  total=sum(r['total'] for r in records),
+                  text_metrics=text_metrics,
+                  slowest=slowest,
+                  documents=documents,
+                  records=records)
+
+    logger.info('blockdiag: %d diagrams (%d cached, %d rendered) in %.3f sec',
+                report['diagrams'], report['cache_hits'], report['cache_misses'], report['total'])
+    logger.info('blockdiag: text metrics cache: %d hits, %d misses (%.1f%%)',
+                hits, misses, text_metrics['hit_rate'] * 100)
+    for record in slowest:
+        logger.info('    %.3f sec  %s: %s (%s nodes, %s edges, cost %s)',
+                    record['total'], record['docname'], record['image'], record['nodes'], record['edges'],
+                    record.get('cost'))
+
+    if isinstance(app.config.blockdiag_render_report, str):
+        path = os.path.join(app.confdir, app.config.blockdiag_render_report)
+    else:
+        path = os.path.join(app.doctreedir, 'blockdiag', 'report.json')
+
+    ensuredir(os.path.dirname(path))
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, indent=2)
+
+
+def on_build_finished(app, exc):
+    flush_deferred_renders(app.builder)
+
+    reused, regenerated = collect_render_counts(app.builder)
+    if exc is None and reused + regenerated:
+        logger.info('blockdiag: %d diagrams reused, %d regenerated', reused, regenerated)
+
+    if app.config.blockdiag_render_report:
+        records = collect_records(app.builder)
+        if exc is None and records:
+            write_report(app, records)
+
+    if exc is None and app.config.blockdiag_prune_images:
+        prune_images(app)
+
+    compact_metadata(app.builder)
+    registry.clear()
+    prerendered_images.clear()
+    used_svg_files.clear()
+
+    if exc is None and app.config.blockdiag_cache_dir and app.config.blockdiag_cache_size:
+        evict_cache(app)
+
+
 def setup(app):
+    import blockdiag  # only the package itself; it does not load the renderers
+
     app.add_node(blockdiag_node,
                  html=(html_visit_blockdiag, html_depart_blockdiag))
     app.add_directive('blockdiag', Blockdiag)
@@ -306,13 +2119,106 @@ def setup(app):
     app.add_config_value('blockdiag_transparency', True, 'html')
     app.add_config_value('blockdiag_debug', False, 'html')
     app.add_config_value('blockdiag_html_image_format', 'PNG', 'html')
+    app.add_config_value('blockdiag_html_svg_embed', 'inline', 'html')
     app.add_config_value('blockdiag_tex_image_format', None, 'html')  # backward compatibility for 1.3.1
     app.add_config_value('blockdiag_latex_image_format', 'PNG', 'html')
+    app.add_config_value('blockdiag_render_workers', None, '', [int, str])
+    app.add_config_value('blockdiag_render_threads', None, '', [int, str])
+    app.add_config_value('blockdiag_html_deferred_render', False, '')
+    app.add_config_value('blockdiag_render_timeout', None, '', [int, float])
+    app.add_config_value('blockdiag_builder_images', {}, '')
+    app.add_config_value('blockdiag_svg_optimize', False, 'html', [bool, int])
+    app.add_config_value('blockdiag_cache_dir', None, '')
+    app.add_config_value('blockdiag_cache_size', 512 * 1024 * 1024, '')
+    app.add_config_value('blockdiag_prune_images', False, '', [bool, str])
+    app.add_config_value('blockdiag_render_report', False, '', [bool, str])
+    app.add_config_value('blockdiag_render_report_limit', 10, '')
+    app.add_config_value('blockdiag_max_nodes', None, 'env', [int])
+    app.add_config_value('blockdiag_max_edges', None, 'env', [int])
+    app.add_config_value('blockdiag_max_group_depth', None, 'env', [int])
+    app.add_config_value('blockdiag_complexity_action', 'refuse', 'env', ENUM('warn', 'refuse'))
     app.connect("builder-inited", on_builder_inited)
+    app.connect("doctree-read", on_doctree_read)
+    app.connect("env-before-read-docs", on_env_before_read_docs)
+    app.connect("env-purge-doc", on_env_purge_doc)
+    app.connect("env-merge-info", on_env_merge_info)
+    app.connect("env-updated", on_env_updated)
     app.connect("doctree-resolved", on_doctree_resolved)
+    app.connect("html-page-context", on_html_page_context)
+    app.connect("build-finished", on_build_finished)
 
     return {
-        'version': pkg_resources.require('blockdiag')[0].version,
+        'version': blockdiag.__version__,
+        'env_version': 2,
         'parallel_read_safe': True,
         'parallel_write_safe': True,
     }
+
+
+def prerender(args):
+    """Render diagrams of a Sphinx project without writing the documents.
+
+    It reads the project with the given builder; the diagrams are rendered
+    on `env-updated` event as blockdiag_render_workers does.  Thus the
+    images are named and placed exactly as sphinx-build does; they are
+    stored into blockdiag_cache_dir too if configured.  The environment is
+    saved as sphinx-build does; the following build does not read the
+    documents again.
+    """
+    import sys
+    from sphinx.application import ENV_PICKLE_FILENAME, Sphinx
+
+    confoverrides = {}
+    for setting in args.define:
+        key, _, value = setting.partition('=')
+        confoverrides[key] = value
+    confoverrides['blockdiag_render_workers'] = get_concurrency(args.jobs)
+
+    doctreedir = args.doctreedir or os.path.join(args.outputdir, '.doctrees')
+    app = Sphinx(args.sourcedir, args.confdir or args.sourcedir, args.outputdir, doctreedir,
+                 args.builder, confoverrides, status=None if args.quiet else sys.stdout, warning=sys.stderr)
+    app.builder.read()
+    with open(os.path.join(doctreedir, ENV_PICKLE_FILENAME), 'wb') as fp:
+        pickle.dump(app.env, fp, pickle.HIGHEST_PROTOCOL)
+
+    compact_metadata(app.builder)
+    registry.clear()
+    return 0
+
+
+def main(argv=None):
+    """Entry point of ``python -m sphinxcontrib.blockdiag``."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m sphinxcontrib.blockdiag')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    command = subparsers.add_parser('prerender', help='render diagrams of a Sphinx project ahead of the build')
+    command.add_argument('sourcedir', help='source directory')
+    command.add_argument('outputdir', help='output directory (same as sphinx-build)')
+    command.add_argument('-b', dest='builder', default='html', help='builder to render images for (default: html)')
+    command.add_argument('-c', dest='confdir', help='directory containing conf.py (default: sourcedir)')
+    command.add_argument('-d', dest='doctreedir', help='doctree directory (default: outputdir/.doctrees)')
+    command.add_argument('-j', dest='jobs', default='auto',
+                         help='number of processes to render diagrams (default: auto)')
+    command.add_argument('-D', dest='define', action='append', default=[], metavar='setting=value',
+                         help='override a setting in conf.py')
+    command.add_argument('-q', dest='quiet', action='store_true', help='no output on stdout')
+    command.set_defaults(func=prerender)
+
+    args = parser.parse_args(argv)
+    try:
+        if get_concurrency(args.jobs) < 1:
+            raise ValueError
+    except ValueError:
+        parser.error('-j: a positive number or "auto" is required: %s' % args.jobs)
+
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    # run the module loaded by Sphinx as the extension, not this copy named __main__;
+    # their globals (ex. metadata_index) are not shared
+    import sys
+    import sphinxcontrib.blockdiag
+    sys.exit(sphinxcontrib.blockdiag.main())
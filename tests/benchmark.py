@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.benchmark
+    ~~~~~~~~~~~~~~~
+
+    Benchmark for sphinxcontrib.blockdiag.
+
+    It generates a Sphinx project having N documents x M diagrams, builds it
+    with html (PNG), html (SVG) and latex (PDF) targets, and reports wall time,
+    peak RSS and the per-phase cost recorded by ``blockdiag_render_report``
+    for a full build and for incremental builds::
+
+        $ python -m tests.benchmark --documents 20 --diagrams 10 --nodes 30
+        $ python -m tests.benchmark --targets html-svg --json result.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TARGETS = {
+    'html-png': ('html', {'blockdiag_html_image_format': 'PNG'}),
+    'html-svg': ('html', {'blockdiag_html_image_format': 'SVG'}),
+    'latex-pdf': ('latex', {'blockdiag_latex_image_format': 'PDF'}),
+}
+SCENARIOS = ('full', 'noop', 'prose', 'diagram')
+LABELS = ('web', 'api', 'auth', 'db', 'cache', 'queue', 'worker', 'search', 'storage', 'mail')
+OPTIONS = ([], [':width: 400'], [':height: 200'], [':scale: 50%'])
+
+CONF = """\
+extensions = ['sphinxcontrib.blockdiag']
+master_doc = 'index'
+project = 'benchmark'
+exclude_patterns = ['_build']
+"""
+
+
+def make_diagram(doc, index, nodes, groupsize, documents):
+    lines = []
+    names = ['%s_%d' % (LABELS[i % len(LABELS)], i) for i in range(nodes)]
+    for i, name in enumerate(names[1:], 1):
+        lines.append('%s -> %s;' % (names[(i - 1) // 2], name))  # binary tree
+
+    if groupsize:
+        for i in range(0, nodes, groupsize):
+            lines.append('group { %s; }' % '; '.join(names[i:i + groupsize]))
+
+    for i, name in enumerate(names[::3]):
+        target = (doc + i + 1) % documents
+        lines.append("%s [href = ':ref:`doc%d`'];" % (name, target))
+
+    options = OPTIONS[index % len(OPTIONS)]
+    body = ['.. blockdiag::'] + ['   ' + option for option in options] + ['']
+    body += ['   ' + line for line in lines]
+    return '\n'.join(body) + '\n'
+
+
+def make_document(doc, args, revision=0):
+    lines = ['.. _doc%d:' % doc, '', 'Document %d' % doc, '=' * 20, '',
+             'Revision %d.' % revision, '']
+    for i in range(args.diagrams):
+        lines.append(make_diagram(doc, i, args.nodes, args.groupsize, args.documents))
+
+    return '\n'.join(lines)
+
+
+def generate_project(srcdir, args):
+    os.makedirs(srcdir)
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as fp:
+        fp.write(CONF)
+
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as fp:
+        fp.write('Benchmark\n=========\n\n.. toctree::\n\n')
+        for doc in range(args.documents):
+            fp.write('   doc%d\n' % doc)
+
+    for doc in range(args.documents):
+        with open(os.path.join(srcdir, 'doc%d.rst' % doc), 'w') as fp:
+            fp.write(make_document(doc, args))
+
+
+def edit_project(srcdir, args, scenario):
+    path = os.path.join(srcdir, 'doc0.rst')
+    if scenario == 'prose':
+        with open(path) as fp:
+            source = fp.read()
+        with open(path, 'w') as fp:
+            fp.write(source.replace('Revision 0.', 'Revision 1.'))
+    elif scenario == 'diagram':
+        with open(path, 'a') as fp:
+            fp.write('\n.. blockdiag::\n\n   edited -> diagram;\n')
+
+
+def run_build(srcdir, builddir, builder, overrides, args):
+    report = os.path.join(builddir, 'report.json')
+    if os.path.exists(report):
+        os.remove(report)
+
+    command = [sys.executable, '-m', 'sphinx', '-q', '-b', builder,
+               '-d', os.path.join(builddir, 'doctrees'),
+               srcdir, os.path.join(builddir, builder)]
+    if args.jobs:
+        command += ['-j', args.jobs]
+    overrides = dict(overrides, blockdiag_render_report=report)
+    if args.fontpath:
+        overrides['blockdiag_fontpath'] = args.fontpath
+    for key, value in overrides.items():
+        command += ['-D', '%s=%s' % (key, value)]
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(command)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - started
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError('sphinx-build failed: %s' % ' '.join(command))
+
+    result = dict(wall=elapsed, maxrss=usage.ru_maxrss)  # KiB on Linux, bytes on macOS
+    if os.path.exists(report):
+        with open(report) as fp:
+            summary = json.load(fp)
+        records = summary['records']
+        result['text_metrics_hit_rate'] = summary['text_metrics']['hit_rate']
+        for phase in ('parse', 'layout', 'draw', 'save'):
+            result[phase] = sum(record[phase] for record in records)
+        result['cached'] = len([record for record in records if record['cached']])
+        result['rendered'] = len([record for record in records if not record['cached']])
+
+    return result
+
+
+def run_target(workdir, target, args):
+    builder, overrides = TARGETS[target]
+    srcdir = os.path.join(workdir, target, 'src')
+    builddir = os.path.join(workdir, target, 'build')
+    generate_project(srcdir, args)
+
+    results = []
+    for scenario in SCENARIOS:
+        edit_project(srcdir, args, scenario)
+        result = run_build(srcdir, builddir, builder, overrides, args)
+        result.update(target=target, scenario=scenario)
+        results.append(result)
+        print_result(result)
+
+    return results
+
+
+def print_result(result):
+    print('%-10s %-8s %8.2fs %8.1fMB  parse=%.2fs layout=%.2fs draw=%.2fs save=%.2fs  '
+          'rendered=%s cached=%s text-metrics-hits=%.0f%%' %
+          (result['target'], result['scenario'], result['wall'], result['maxrss'] / 1024.0,
+           result.get('parse', 0), result.get('layout', 0), result.get('draw', 0), result.get('save', 0),
+           result.get('rendered', 0), result.get('cached', 0), result.get('text_metrics_hit_rate', 0) * 100))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sphinxcontrib.blockdiag')
+    parser.add_argument('--documents', type=int, default=10, help='number of documents')
+    parser.add_argument('--diagrams', type=int, default=5, help='number of diagrams per document')
+    parser.add_argument('--nodes', type=int, default=20, help='number of nodes per diagram')
+    parser.add_argument('--groupsize', type=int, default=5, help='number of nodes per group (0: no groups)')
+    parser.add_argument('--targets', default='html-png,html-svg,latex-pdf',
+                        help='comma separated list of %s' % ', '.join(sorted(TARGETS)))
+    parser.add_argument('--fontpath', help='TrueType font (required by latex-pdf)')
+    parser.add_argument('-j', '--jobs', help='passed to sphinx-build -j')
+    parser.add_argument('--workdir', help='directory for generated projects (default: temporary)')
+    parser.add_argument('--json', help='write results to the file as JSON')
+    args = parser.parse_args(argv)
+
+    targets = args.targets.split(',')
+    for target in targets:
+        if target not in TARGETS:
+            parser.error('unknown target: %s' % target)
+    if 'latex-pdf' in targets and not args.fontpath:
+        print('latex-pdf: skipped (--fontpath is required)')
+        targets.remove('latex-pdf')
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    try:
+        results = []
+        for target in targets:
+            results += run_target(workdir, target, args)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, True)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(settings=vars(args), results=results), fp, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import zipfile
+from mock import patch
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+
+
+class TestSphinxcontribBlockdiagBuilders(unittest.TestCase):
+    @with_app(srcdir='tests/docs/basic', buildername='text', write_docstring=True)
+    @patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer")
+    def test_skip_rendering_for_text(self, app, status, warning, to_drawer):
+        """
+        .. blockdiag::
+           :alt: network diagram
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertFalse(to_drawer.called)
+        self.assertIn('[image: network diagram]', (app.outdir / 'index.txt').read_text(encoding='utf-8'))
+        self.assertEqual([], [name for name in os.listdir(app.outdir) if name.startswith('blockdiag-')])
+
+    @with_app(srcdir='tests/docs/basic', buildername='linkcheck', write_docstring=True)
+    @patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer")
+    def test_skip_rendering_for_linkcheck(self, app, status, warning, to_drawer):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertFalse(to_drawer.called)
+
+    @with_app(srcdir='tests/docs/basic', buildername='text', write_docstring=True,
+              confoverrides={'blockdiag_builder_images': {'text': True}})
+    def test_builder_images_override(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertEqual(1, len([name for name in os.listdir(app.outdir) if name.startswith('blockdiag-')]))
+
+    @with_app(srcdir='tests/docs/basic', buildername='epub', write_docstring=True,
+              confoverrides={'blockdiag_html_deferred_render': True})
+    def test_deferred_render_on_epub(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        def slow_draw_image(*args):
+            time.sleep(1)  # still drawing when the builder packages outdir if deferred
+            return draw_image(*args)
+
+        draw_image = sphinxcontrib.blockdiag.draw_image
+        with patch("sphinxcontrib.blockdiag.draw_image", side_effect=slow_draw_image):
+            app.build(True)
+
+        epubs = [name for name in os.listdir(app.outdir) if name.endswith('.epub')]
+        with zipfile.ZipFile(app.outdir / epubs[0]) as epub:
+            images = [name for name in epub.namelist() if name.startswith('_images/blockdiag-')]
+            self.assertEqual(1, len(images))
+            self.assertIn(images[0], epub.read('content.opf').decode('utf-8'))
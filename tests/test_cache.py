@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import tempfile
+from blockdiag.drawer import DiagramDraw
+from mock import patch
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'sphinxcontrib-blockdiag-test-cache')
+
+
+with_png_app = with_app(srcdir='tests/docs/basic',
+                        buildername='html',
+                        write_docstring=True)
+with_svg_app = with_app(srcdir='tests/docs/basic',
+                        buildername='html',
+                        write_docstring=True,
+                        confoverrides={
+                            'blockdiag_html_image_format': 'SVG'
+                        })
+
+
+class TestSphinxcontribBlockdiagCache(unittest.TestCase):
+    @with_png_app
+    def test_png_cache_hit_skips_layout(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        expected = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertIn('href="#target"', expected)
+
+        with patch("blockdiag.utils.rst.nodes.blockdiag.processor.drawer.DiagramDraw") as DiagramDraw:
+            app.builder.build_all()
+            self.assertFalse(DiagramDraw.called)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(re.sub(r'map_\d+', 'map', expected), re.sub(r'map_\d+', 'map', source))
+
+    @with_svg_app
+    def test_svg_cache_hit_skips_drawing(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        expected = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertIn('xlink:href="#target"', expected)
+
+        with patch("blockdiag.utils.rst.nodes.blockdiag.processor.drawer.DiagramDraw") as DiagramDraw:
+            app.builder.build_all()
+            self.assertFalse(DiagramDraw.called)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(expected, source)
+
+    @with_png_app
+    def test_metadata_index(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        app.build(True)
+        expected = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(['metadata.pickle'],
+                         [name for name in os.listdir(app.doctreedir / 'blockdiag') if name.startswith('meta')])
+        self.assertEqual([], [name for name in os.listdir(app.doctreedir / 'blockdiag') if name.endswith('.png.json')])
+
+        # emulate a new process
+        sphinxcontrib.blockdiag.registry.clear()
+        sphinxcontrib.blockdiag.load_metadata_index(app.builder)
+        self.assertEqual(1, len(sphinxcontrib.blockdiag.metadata_index))
+        with patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer") as to_drawer:
+            app.builder.build_all()
+            self.assertFalse(to_drawer.called)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(re.sub(r'map_\d+', 'map', expected), re.sub(r'map_\d+', 'map', source))
+
+    @with_png_app
+    def test_filename_is_hashed_on_reading(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        get_path = sphinxcontrib.blockdiag.blockdiag_node.get_path
+        with patch.object(sphinxcontrib.blockdiag.blockdiag_node, 'get_path',
+                          autospec=True, side_effect=get_path) as hashed:
+            app.builder.build_all()
+            self.assertEqual(1, hashed.call_count)  # in the read phase
+
+            # settings changed after reading; the stored filename is out of date
+            app.config.blockdiag_antialias = True
+            sphinxcontrib.blockdiag.render_settings.clear()
+            app.builder.build_all()
+            self.assertEqual(3, hashed.call_count)  # in the write phase (for the path and the URI)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = os.listdir(app.outdir / '_images')
+        self.assertEqual(2, len(images))
+        self.assertEqual(1, len([name for name in images if name in source]))
+
+    @with_svg_app
+    def test_identical_diagrams_are_drawn_once(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           A -> B;
+        """
+        with patch("blockdiag.utils.rst.nodes.blockdiag.processor.drawer.DiagramDraw",
+                   wraps=DiagramDraw) as drawer:
+            app.builder.build_all()
+            self.assertEqual(1, drawer.call_count)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, source.count('<svg '))
+
+    @with_png_app
+    def test_reuse_diagrams_on_prose_change(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        self.assertIn('blockdiag: 0 diagrams reused, 1 regenerated', status.getvalue())
+
+        (app.srcdir / 'index.rst').write_text('Hello world\n\n.. blockdiag::\n\n   A -> B;\n', encoding='utf-8')
+        with patch("sphinxcontrib.blockdiag.blockdiag_node.to_diagram") as to_diagram:
+            app.build()
+            self.assertFalse(to_diagram.called)
+
+        self.assertIn('blockdiag: 1 diagrams reused, 0 regenerated', status.getvalue())
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertIn('Hello world', source)
+        self.assertRegexpMatches(source, '<div class="align-default"><img .*? src="_images/.*?.png" .*?/></div>')
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_cache_dir': CACHE_DIR})
+    def test_shared_cache_dir(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        shutil.rmtree(CACHE_DIR, True)
+        try:
+            app.builder.build_all()
+            expected = (app.outdir / 'index.html').read_text(encoding='utf-8')
+            self.assertEqual(2, len(os.listdir(os.path.join(CACHE_DIR, os.listdir(CACHE_DIR)[0]))))
+
+            # emulate a fresh build directory
+            shutil.rmtree(app.outdir / '_images')
+            shutil.rmtree(app.doctreedir / 'blockdiag')
+            sphinxcontrib.blockdiag.registry.clear()
+            sphinxcontrib.blockdiag.metadata_index.clear()
+            with patch("blockdiag.utils.rst.nodes.blockdiag.processor.drawer.DiagramDraw") as DiagramDraw:
+                app.builder.build_all()
+                self.assertFalse(DiagramDraw.called)
+
+            self.assertEqual(1, len(os.listdir(app.outdir / '_images')))
+            source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+            self.assertEqual(re.sub(r'map_\d+', 'map', expected), re.sub(r'map_\d+', 'map', source))
+        finally:
+            shutil.rmtree(CACHE_DIR, True)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_cache_dir': CACHE_DIR, 'blockdiag_cache_size': 1})
+    def test_shared_cache_eviction(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        shutil.rmtree(CACHE_DIR, True)
+        try:
+            app.build(True)
+            self.assertIn('blockdiag: 2 files evicted from cache', status.getvalue())
+            self.assertEqual([], os.listdir(os.path.join(CACHE_DIR, os.listdir(CACHE_DIR)[0])))
+        finally:
+            shutil.rmtree(CACHE_DIR, True)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_cache_dir': CACHE_DIR, 'blockdiag_cache_size': 1})
+    def test_shared_cache_eviction_keeps_foreign_files(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        shutil.rmtree(CACHE_DIR, True)
+        try:
+            import blockdiag
+            foreign = [os.path.join(CACHE_DIR, 'other-tool', 'important.bin'),
+                       os.path.join(CACHE_DIR, 'other-tool', 'blockdiag-%s.png' % ('0' * 40)),
+                       os.path.join(CACHE_DIR, 'important.bin'),
+                       os.path.join(CACHE_DIR, blockdiag.__version__, 'important.bin'),
+                       os.path.join(CACHE_DIR, blockdiag.__version__, '.tmp-important.bin')]
+            for path in foreign:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as fp:
+                    fp.write('x' * 1000)
+                os.utime(path, (0, 0))  # older than the files of blockdiag
+
+            app.build(True)
+            self.assertIn('blockdiag: 2 files evicted from cache', status.getvalue())
+            for path in foreign:
+                self.assertTrue(os.path.exists(path), path)
+        finally:
+            shutil.rmtree(CACHE_DIR, True)
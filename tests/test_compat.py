@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from blockdiag.utils.rst import directives, nodes
+from docutils import nodes as docutils_nodes
+
+import unittest
+import sphinxcontrib.blockdiag
+from sphinxcontrib.blockdiag import Blockdiag, blockdiag_node
+
+
+ARGUMENTS = {
+    'align': ['left', 'center', 'right', 'top', ''],
+    'figwidth': ['image', 'IMAGE', '100', '100px', '50%', 'wide'],
+}
+
+
+def call(func, argument):
+    try:
+        return func(argument)
+    except (ValueError, TypeError) as exc:
+        return type(exc)
+
+
+class TestSphinxcontribBlockdiagCompat(unittest.TestCase):
+    """The parts copied from blockdiag must be kept in sync with it."""
+
+    def test_option_spec(self):
+        upstream = directives.BlockdiagDirectiveBase.option_spec
+        self.assertEqual(sorted(upstream), sorted(Blockdiag.option_spec))
+        for name, func in upstream.items():
+            if name in ARGUMENTS:
+                for argument in ARGUMENTS[name]:
+                    self.assertEqual(call(func, argument), call(Blockdiag.option_spec[name], argument))
+            else:
+                self.assertIs(func, Blockdiag.option_spec[name], name)
+
+    def test_directive_attributes(self):
+        for name in ('has_content', 'required_arguments', 'optional_arguments', 'final_argument_whitespace'):
+            self.assertEqual(getattr(directives.BlockdiagDirectiveBase, name), getattr(Blockdiag, name), name)
+
+    def test_get_path(self):
+        options = dict(format='PNG', antialias=False, fontpath=None, fontmap=None, transparency=True)
+        for code, node_options in (('A -> B;', {}), ('blockdiag { A -> B; }', {'width': '200', 'alt': 'x'})):
+            upstream = nodes.blockdiag(code=code, options=node_options)
+            node = blockdiag_node(code=code, options=node_options)
+            self.assertEqual(upstream.get_path(**dict(options)), node.get_path(**dict(options)))
+
+    def test_to_diagram(self):
+        for code in ('A -> B;', 'blockdiag { A -> B; }', 'blockdiag admin { A -> B -> C; }'):
+            upstream = nodes.blockdiag(code=code)
+            node = blockdiag_node(code=code)
+            expected = upstream.to_diagram()
+            diagram = node.to_diagram()
+            self.assertEqual(upstream['code'], node['code'])
+            self.assertEqual([n.id for n in expected.traverse_nodes()], [n.id for n in diagram.traverse_nodes()])
+
+    def test_node_class(self):
+        self.assertEqual(nodes.blockdiag.name, blockdiag_node.name)
+        self.assertTrue(issubclass(blockdiag_node, docutils_nodes.General))
+        self.assertTrue(issubclass(blockdiag_node, docutils_nodes.Element))
+        self.assertIs(sphinxcontrib.blockdiag.get_directive_class().node_class, blockdiag_node)
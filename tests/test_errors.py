@@ -3,7 +3,9 @@
 from mock import patch
 from sphinx_testing import with_app
 
+import os
 import sys
+import time
 import unittest
 
 
@@ -52,3 +54,74 @@ class TestSphinxcontribBlockdiagErrors(unittest.TestCase):
         app.builder.build_all()
         self.assertIn('UnicodeEncodeError caught (check your font settings)',
                       warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', write_docstring=True, confoverrides=dict(blockdiag_render_timeout=0.5))
+    @patch("sphinxcontrib.blockdiag.blockdiag.drawer.DiagramDraw.draw")
+    def test_render_timeout(self, app, status, warning, draw):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        draw.side_effect = lambda *args: time.sleep(60)
+        started = time.time()
+        app.builder.build_all()
+        self.assertLess(time.time() - started, 30)
+        self.assertIn("dot code 'blockdiag { A -> B; }': rendering took longer than 0.5 seconds", warning.getvalue())
+        self.assertNotIn('<img', (app.outdir / 'index.html').read_text(encoding='utf-8'))
+        self.assertEqual([], os.listdir(app.outdir / '_images'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides=dict(blockdiag_render_timeout=30))
+    @patch("sphinxcontrib.blockdiag.blockdiag.drawer.DiagramDraw.draw")
+    def test_rendering_error_under_watchdog(self, app, status, warning, draw):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        draw.side_effect = RuntimeError("UNKNOWN ERROR!")
+        app.builder.build_all()
+        self.assertIn('UNKNOWN ERROR!', warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', write_docstring=True,
+              confoverrides=dict(blockdiag_max_nodes='3', blockdiag_max_group_depth=1))  # '3' as given by -D
+    @patch("sphinxcontrib.blockdiag.blockdiag.builder.ScreenNodeBuilder.build")
+    def test_complexity_limit(self, app, status, warning, build):
+        """
+        .. blockdiag::
+
+           A -> B, C -> D;
+           group { group { E; } }
+        """
+        app.builder.build_all()
+        self.assertFalse(build.called)
+        self.assertIn('diagram is too complex: 5 nodes (blockdiag_max_nodes = 3), '
+                      '2 depth (blockdiag_max_group_depth = 1)', warning.getvalue())
+        self.assertNotIn('<img', (app.outdir / 'index.html').read_text(encoding='utf-8'))
+
+    @with_app(srcdir='tests/docs/basic', write_docstring=True,
+              confoverrides=dict(blockdiag_max_edges=1, blockdiag_complexity_action='warn'))
+    def test_complexity_limit_warning(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B, C -> D;
+        """
+        app.builder.build_all()
+        self.assertIn('index.rst:2: WARNING: diagram is too complex: 4 edges (blockdiag_max_edges = 1)',
+                      warning.getvalue())
+        self.assertIn('<img', (app.outdir / 'index.html').read_text(encoding='utf-8'))
+        self.assertEqual([('index', dict(nodes=4, edges=4, groups=0, depth=0, cost=8))],
+                         [(docname, diagrams[0][3]) for docname, diagrams in app.env.blockdiag_diagrams.items()])
+
+    @with_app(srcdir='tests/docs/basic', write_docstring=True,
+              confoverrides=dict(blockdiag_max_nodes=1, blockdiag_complexity_action='wran'))
+    def test_unknown_complexity_action(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertRegexpMatches(warning.getvalue(), 'The config value `blockdiag_complexity_action` .* `wran`')
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+from blockdiag.utils.fontmap import FontMap
+from mock import Mock, patch
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+
+
+class TestSphinxcontribBlockdiagFonts(unittest.TestCase):
+    def setUp(self):
+        sphinxcontrib.blockdiag.fontmaps.clear()
+        sphinxcontrib.blockdiag.loaded_fonts.clear()
+
+    def test_fontmap_cache(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False) as fp:
+            fp.write('[fontmap]\n')
+        try:
+            with patch("blockdiag.utils.fontmap.FontMap", wraps=FontMap) as fontmap:
+                sphinxcontrib.blockdiag.setup_fontmap(fp.name, None)
+                sphinxcontrib.blockdiag.setup_fontmap(fp.name, None)
+                self.assertEqual(1, fontmap.call_count)
+
+                mtime = os.stat(fp.name).st_mtime
+                os.utime(fp.name, (mtime + 10, mtime + 10))
+                sphinxcontrib.blockdiag.setup_fontmap(fp.name, None)
+                self.assertEqual(2, fontmap.call_count)
+        finally:
+            os.remove(fp.name)
+
+    def test_shared_font_loader(self):
+        loader = Mock(side_effect=lambda path, size: object())
+        load = sphinxcontrib.blockdiag.shared_font_loader(loader, lambda path, size: ('TEST', path, size))
+        self.assertIs(load('font.ttf', 11), load('font.ttf', 11))
+        self.assertIsNot(load('font.ttf', 11), load('font.ttf', 20))
+        self.assertEqual(2, loader.call_count)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_fontpath': '/nonexistent/font.ttf'})
+    def test_font_not_found(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertIn('fontfile is not found', warning.getvalue())
@@ -1,19 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+from mock import patch
 from sphinx_testing import with_app
 
 import unittest
+import sphinxcontrib.blockdiag
 
 
 with_png_app = with_app(srcdir='tests/docs/basic',
                         buildername='html',
                         write_docstring=True)
+with_deferred_app = with_app(srcdir='tests/docs/basic',
+                             buildername='html',
+                             write_docstring=True,
+                             confoverrides={
+                                 'blockdiag_html_deferred_render': True
+                             })
 with_svg_app = with_app(srcdir='tests/docs/basic',
                         buildername='html',
                         write_docstring=True,
                         confoverrides={
                             'blockdiag_html_image_format': 'SVG'
                         })
+with_svg_file_app = with_app(srcdir='tests/docs/basic',
+                             buildername='html',
+                             write_docstring=True,
+                             confoverrides={
+                                 'blockdiag_html_image_format': 'SVG',
+                                 'blockdiag_html_svg_embed': 'file',
+                             })
 
 
 class TestSphinxcontribBlockdiagHTML(unittest.TestCase):
@@ -221,6 +238,69 @@ class TestSphinxcontribBlockdiagHTML(unittest.TestCase):
                                           '<area shape="rect" coords="64.0,40.0,192.0,80.0" href="#hello-world">'
                                           '</map><img .*? src=".*?.png" usemap="#\\1" .*?/></div>'))
 
+    @with_deferred_app
+    def test_deferred_render_png_image(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        with patch("sphinxcontrib.blockdiag.defer_render", wraps=sphinxcontrib.blockdiag.defer_render) as defer_render:
+            app.build(True)
+            self.assertEqual(1, defer_render.call_count)
+
+        self.assertIn('blockdiag: 1 diagrams reused, 1 regenerated', status.getvalue())
+        self.assertEqual({}, sphinxcontrib.blockdiag.deferred_renders)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = re.findall('<area shape="rect" coords="64.0,40.0,192.0,80.0" href="http://blockdiag.com/"></map>'
+                            '<img .*? src="(_images/.*?.png)" .*?/></div>', source)
+        self.assertEqual(2, len(images))
+        self.assertTrue(os.path.isfile(app.outdir / images[0]))
+
+    @with_deferred_app
+    def test_deferred_render_error(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        with patch("blockdiag.drawer.DiagramDraw.draw", side_effect=RuntimeError("draw failed")):
+            app.build(True)
+
+        self.assertIn("dot code 'blockdiag { A -> B; }': draw failed", warning.getvalue())
+        self.assertEqual([], os.listdir(app.outdir / '_images'))
+
+    @with_png_app
+    def test_anonymous_reftarget_in_href_on_png(self, app, status, warning):
+        """
+        .. _target:
+
+        paragraph
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+
+        .. blockdiag::
+
+           C -> D;
+           C [href = ':ref:`target`'];
+        """
+        with patch("sphinxcontrib.blockdiag.lookup_reference",
+                   wraps=sphinxcontrib.blockdiag.lookup_reference) as lookup_reference:
+            app.builder.build_all()
+            self.assertEqual(1, lookup_reference.call_count)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, source.count('href="#target"'))
+
     @with_png_app
     def test_missing_reftarget_in_href_on_png(self, app, status, warning):
         """
@@ -259,6 +339,44 @@ class TestSphinxcontribBlockdiagHTML(unittest.TestCase):
         self.assertRegexpMatches(source, ('<div class="align-default">'
                                           '<svg height="60.0" viewBox="0 0 448 120" width="224.0" .*?>'))
 
+    @with_svg_app
+    def test_svg_is_streamed(self, app, status, warning):
+        """
+        .. blockdiag::
+           :width: 224
+
+           A -> B;
+        """
+        with patch("blockdiag.imagedraw.simplesvg.svg.to_xml") as to_xml:
+            app.builder.build_all()
+            self.assertFalse(to_xml.called)
+
+        # the documents are not kept in memory after written into the body
+        self.assertEqual([], [value for value in sphinxcontrib.blockdiag.registry.values()
+                              if isinstance(value, str) and value.startswith('<svg')])
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, ('<div class="align-default">'
+                                          '<svg height="60.0" viewBox="0 0 448 120" width="224.0" .*?>'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_html_image_format': 'SVG', 'blockdiag_svg_optimize': True})
+    def test_svg_optimize(self, app, status, warning):
+        """
+        .. blockdiag::
+           :width: 224
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, ('<div class="align-default">'
+                                          '<svg height="60" viewBox="0 0 448 120" width="224" .*?>'
+                                          r'<style>\.blockdiag-[0-9a-f]{8}\{'))
+        self.assertRegexpMatches(source, '<text textLength="6" x="128" y="66" class="blockdiag-[0-9a-f]{8}">A</text>')
+        self.assertNotIn('inkspace', source)
+        self.assertNotIn('\n  <rect', source)
+
     @with_svg_app
     def test_height_option_on_svg(self, app, status, warning):
         """
@@ -384,6 +502,44 @@ class TestSphinxcontribBlockdiagHTML(unittest.TestCase):
         self.assertNotRegex(source, '<a xlink:href="#hello-world">\\n\\s*<rect .*?>\\n\\s*</a>')
         self.assertIn('undefined label: unknown_target', warning.getvalue())
 
+    @with_svg_file_app
+    def test_svg_file(self, app, status, warning):
+        """
+        .. blockdiag::
+           :width: 224
+           :alt: diagram
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, ('<div class="align-default"><img alt="diagram" height="60.0" '
+                                          'src="_images/blockdiag-.*?.svg" width="224.0" /></div>'))
+        self.assertNotIn('<svg', source)
+        self.assertEqual(1, len(os.listdir(app.outdir / '_images')))
+
+    @with_svg_file_app
+    def test_reftarget_in_href_on_svg_file(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, ('<div class="align-default"><object data="_images/blockdiag-.*?.svg" '
+                                          'height="120" type="image/svg\\+xml" width="448"></object></div>'))
+
+        filename = os.listdir(app.outdir / '_images')[0]
+        image = (app.outdir / '_images' / filename).read_text(encoding='utf-8')
+        self.assertRegexpMatches(image, '<a target="_top" xlink:href="../index.html#target">')
+
     @with_svg_app
     def test_autoclass_should_not_effect_to_other_diagram(self, app, status, warning):
         """
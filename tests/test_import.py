@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from shutil import rmtree
+
+import unittest
+
+
+# seconds to import the extension (Sphinx and docutils are already loaded); measured
+# by ``python -X importtime`` to be stable on loaded machines.  The extension itself
+# takes a few milliseconds.
+IMPORT_TIME_BUDGET = 0.1
+CUMULATIVE_IMPORT_TIME_BUDGET = 0.3
+
+HEAVY_MODULES = ['blockdiag.drawer', 'blockdiag.utils.bootstrap', 'PIL', 'reportlab', 'pkg_resources']
+BUILD_MODULES = [name for name in HEAVY_MODULES if name != 'PIL']  # Sphinx itself imports PIL
+
+IMPORT_SCRIPT = """
+import json, sys
+import docutils.parsers.rst, sphinx.application, sphinx.util.osutil
+import sphinxcontrib.blockdiag
+print(json.dumps(dict(modules=[name for name in %r if name in sys.modules])))
+""" % HEAVY_MODULES
+
+IMPORTTIME_SCRIPT = ("import docutils.parsers.rst, sphinx.application, sphinx.config, sphinx.util.osutil; "
+                     "import sphinxcontrib.blockdiag")
+
+BUILD_SCRIPT = """
+import json, sys
+from sphinx.application import Sphinx
+app = Sphinx(sys.argv[1], sys.argv[1], sys.argv[2], sys.argv[2] + '/.doctrees', 'html', status=None)
+app.build()
+print(json.dumps(dict(modules=[name for name in %r if name in sys.modules])))
+""" % BUILD_MODULES
+
+
+def run_python(script, *args):
+    output = subprocess.check_output([sys.executable, '-c', script] + list(args))
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def measure_import_time():
+    """Return the self and the cumulative time in seconds to import the extension.
+
+    The source is compiled in advance; compiling is not the cost of the extension.
+    """
+    pycache = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        command = [sys.executable, '-X', 'pycache_prefix=' + pycache, '-c', IMPORTTIME_SCRIPT]
+        subprocess.check_call(command, env=env)
+        proc = subprocess.run(command[:3] + ['-X', 'importtime'] + command[3:], env=env,
+                              stderr=subprocess.PIPE, check=True)
+    finally:
+        rmtree(pycache, True)
+
+    for line in proc.stderr.decode('utf-8').splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'sphinxcontrib.blockdiag':
+            return int(fields[0].split(':')[1]) / 1e6, int(fields[1]) / 1e6
+
+
+class TestSphinxcontribBlockdiagImport(unittest.TestCase):
+    def test_import(self):
+        result = run_python(IMPORT_SCRIPT)
+        self.assertEqual([], result['modules'])
+
+    def test_import_time(self):
+        elapsed, cumulative = measure_import_time()
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+        self.assertLess(cumulative, CUMULATIVE_IMPORT_TIME_BUDGET)
+
+    def test_build_without_diagrams(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = os.path.join(tmpdir, 'src')
+            os.makedirs(srcdir)
+            with open(os.path.join(srcdir, 'conf.py'), 'w') as fp:
+                fp.write("extensions = ['sphinxcontrib.blockdiag']\n")
+            with open(os.path.join(srcdir, 'index.rst'), 'w') as fp:
+                fp.write('Hello world\n')
+
+            result = run_python(BUILD_SCRIPT, srcdir, os.path.join(tmpdir, 'out'))
+            self.assertEqual([], result['modules'])
+        finally:
+            rmtree(tmpdir, True)
@@ -2,9 +2,11 @@
 
 import os
 import re
+from mock import patch
 from sphinx_testing import with_app
 
 import unittest
+import sphinxcontrib.blockdiag
 
 CR = "\r?\n"
 
@@ -197,3 +199,44 @@ class TestSphinxcontribBlockdiagLatex(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{blockdiag-.*?}.png}')
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+                             'blockdiag_render_threads': 2})
+    def test_render_threads(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           C -> D;
+           C [shape = unknown];
+
+        .. blockdiag::
+
+           E -> F;
+        """
+        app.builder.build_all()
+        self.assertIn('unknown node shape: unknown', warning.getvalue())
+
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        images = re.findall(r'\\sphinxincludegraphics{{(blockdiag-.*?)}.png}', source)
+        self.assertEqual(2, len(images))
+        for name in images:
+            self.assertTrue(os.path.exists(app.outdir / (name + '.png')))
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={'blockdiag_render_threads': 'auto'})  # a string as given by -D
+    def test_auto_render_threads(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        get_concurrency = sphinxcontrib.blockdiag.get_concurrency
+        with patch("sphinxcontrib.blockdiag.get_concurrency", side_effect=get_concurrency) as concurrency:
+            app.builder.build_all()
+            concurrency.assert_any_call('auto')
+        self.assertNotIn('blockdiag_render_threads', warning.getvalue())
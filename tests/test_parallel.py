@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import tempfile
+from mock import patch
+from shutil import rmtree
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+from sphinxcontrib.blockdiag import acquire_render, commit_render, abort_render
+
+
+class TestSphinxcontribBlockdiagParallel(unittest.TestCase):
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_render_workers': 2})
+    @patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer")
+    def test_prerender_png_images(self, app, status, warning, to_drawer):
+        """
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        to_drawer.side_effect = RuntimeError("rendered in write phase")
+        app.builder.build_all()
+        self.assertNotIn('rendered in write phase', warning.getvalue())
+        self.assertIn('rendering 1 diagrams with 2 workers', status.getvalue())
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, ('<area shape="rect" coords="64.0,40.0,192.0,80.0" '
+                                          'href="http://blockdiag.com/"></map>'
+                                          '<img .*? src="(_images/.*?.png)" .*?/></div>'))
+        self.assertEqual(1, len(os.listdir(app.outdir / '_images')))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_render_workers': 2,
+                             'blockdiag_html_image_format': 'SVG'})
+    @patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer")
+    def test_prerender_svg_images(self, app, status, warning, to_drawer):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        to_drawer.side_effect = RuntimeError("rendered in write phase")
+        app.builder.build_all()
+        self.assertNotIn('rendered in write phase', warning.getvalue())
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, '<div class="align-default"><svg .*?>')
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={'blockdiag_render_workers': 2})
+    @patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer")
+    def test_prerender_latex_images(self, app, status, warning, to_drawer):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        to_drawer.side_effect = RuntimeError("rendered in write phase")
+        app.builder.build_all()
+        self.assertNotIn('rendered in write phase', warning.getvalue())
+
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{blockdiag-.*?}.png}')
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_render_workers': 2})
+    def test_prerender_error(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+           A [shape = unknown];
+        """
+        app.builder.build_all()
+        self.assertIn('unknown node shape: unknown', warning.getvalue())
+
+
+def leave_stale_lock(app, imagedir):
+    """Remove the rendered image, and leave a lock having our pid for it."""
+    images = [name for name in os.listdir(imagedir) if name.startswith('blockdiag-')]
+    for image in images:
+        os.remove(os.path.join(imagedir, image))
+        with open(app.doctreedir / 'blockdiag' / (image + '.lock'), 'w') as fp:
+            fp.write(str(os.getpid()))
+
+    return images
+
+
+class TestSphinxcontribBlockdiagWorkers(unittest.TestCase):
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_render_workers': 'auto'})  # a string as given by -D
+    def test_auto_workers(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertNotIn('blockdiag_render_workers', warning.getvalue())
+        self.assertIn('rendering 1 diagrams with %d workers' % (os.cpu_count() or 1), status.getvalue())
+
+
+class TestSphinxcontribBlockdiagStaleLock(unittest.TestCase):
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_html_deferred_render': True})
+    def test_stale_lock_on_html(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        images = leave_stale_lock(app, app.outdir / '_images')
+        self.assertEqual(1, len(images))
+
+        sphinxcontrib.blockdiag.registry.clear()
+        app.build(True)
+        self.assertEqual(images, os.listdir(app.outdir / '_images'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True)
+    def test_stale_lock_on_latex(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        images = leave_stale_lock(app, app.outdir)
+        self.assertEqual(1, len(images))
+
+        app.build(True)
+        self.assertIn(images[0], os.listdir(app.outdir))
+
+
+class TestSphinxcontribBlockdiagRenderLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blockdiag-hash.png')
+        self.lockpath = os.path.join(self.tmpdir, 'locks', 'blockdiag-hash.png.lock')
+
+    def tearDown(self):
+        rmtree(self.tmpdir, True)
+
+    def test_commit_render(self):
+        filename = acquire_render(self.path, self.lockpath)
+        self.assertNotEqual(self.path, filename)
+        self.assertTrue(os.path.exists(self.lockpath))
+        self.assertIsNone(acquire_render(self.path, self.lockpath))  # being rendered in this process
+
+        with open(filename, 'w') as fp:
+            fp.write('image')
+        commit_render(filename, self.path, self.lockpath)
+        self.assertEqual(['blockdiag-hash.png', 'locks'], sorted(os.listdir(self.tmpdir)))
+        self.assertFalse(os.path.exists(self.lockpath))
+        self.assertIsNone(acquire_render(self.path, self.lockpath))  # already rendered
+
+    def test_abort_render(self):
+        filename = acquire_render(self.path, self.lockpath)
+        with open(filename, 'w') as fp:
+            fp.write('broken')
+        abort_render(filename, self.lockpath)
+        self.assertEqual(['locks'], os.listdir(self.tmpdir))
+        self.assertIsNotNone(acquire_render(self.path, self.lockpath))
+
+    @unittest.skipUnless(os.name == 'posix', "requires POSIX")
+    def test_stale_lock(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        os.makedirs(os.path.dirname(self.lockpath))
+        with open(self.lockpath, 'w') as fp:
+            fp.write(str(process.pid))
+
+        self.assertIsNotNone(acquire_render(self.path, self.lockpath))
+
+    def test_stale_lock_with_own_pid(self):
+        # left by a killed process having the same pid (ex. in a container)
+        os.makedirs(os.path.dirname(self.lockpath))
+        with open(self.lockpath, 'w') as fp:
+            fp.write(str(os.getpid()))
+
+        self.assertIsNotNone(acquire_render(self.path, self.lockpath))
+        self.assertIsNone(acquire_render(self.path, self.lockpath))  # being rendered in this process
+
+    def test_wait_for_other_process(self):
+        os.makedirs(os.path.dirname(self.lockpath))
+        with open(self.lockpath, 'w') as fp:
+            fp.write(str(os.getppid()))
+
+        def render(seconds):
+            with open(self.path, 'w') as fp:
+                fp.write('image')
+
+        with patch("sphinxcontrib.blockdiag.time.sleep", side_effect=render) as sleep:
+            self.assertIsNone(acquire_render(self.path, self.lockpath))
+            self.assertEqual(1, sleep.call_count)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import tempfile
+from io import StringIO
+from mock import patch
+from shutil import rmtree
+from sphinx.application import Sphinx
+
+import unittest
+from sphinxcontrib.blockdiag import main
+
+SOURCE = """\
+.. blockdiag::
+
+   A -> B;
+
+.. blockdiag::
+   :width: 200
+
+   A -> C;
+"""
+
+
+class TestSphinxcontribBlockdiagPrerender(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        os.makedirs(self.srcdir)
+        with open(os.path.join(self.srcdir, 'conf.py'), 'w') as fp:
+            fp.write("extensions = ['sphinxcontrib.blockdiag']\n")
+        with open(os.path.join(self.srcdir, 'index.rst'), 'w') as fp:
+            fp.write(SOURCE)
+
+    def tearDown(self):
+        rmtree(self.tmpdir, True)
+
+    def test_prerender(self):
+        self.assertEqual(0, main(['prerender', self.srcdir, self.outdir, '-j', '2', '-q']))
+        images = os.listdir(os.path.join(self.outdir, '_images'))
+        self.assertEqual(2, len(images))
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, 'index.html')))
+        self.assertEqual(['metadata.pickle'],
+                         [name for name in os.listdir(os.path.join(self.outdir, '.doctrees', 'blockdiag'))
+                          if name.startswith('metadata') or name.endswith('.json')])
+
+        # the following build reuses the environment and the images
+        status = StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, os.path.join(self.outdir, '.doctrees'),
+                     'html', status=status)
+        with patch("sphinxcontrib.blockdiag.blockdiag_node.to_drawer") as to_drawer:
+            app.build()
+            self.assertFalse(to_drawer.called)
+        self.assertIn('0 added, 0 changed, 0 removed', status.getvalue())
+
+        self.assertEqual(sorted(images), sorted(os.listdir(os.path.join(self.outdir, '_images'))))
+        with open(os.path.join(self.outdir, 'index.html'), encoding='utf-8') as fp:
+            self.assertEqual(2, fp.read().count('src="_images/blockdiag-'))
+
+    def test_prerender_with_overrides(self):
+        main(['prerender', self.srcdir, self.outdir, '-j', '1', '-q',
+              '-D', 'blockdiag_html_image_format=SVG'])
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, '_images')))
+        svgs = [name for name in os.listdir(os.path.join(self.outdir, '.doctrees', 'blockdiag'))
+                if name.endswith('.svg')]
+        self.assertEqual(2, len(svgs))
+
+    def test_prerender_without_jobs(self):
+        with patch('sys.stderr', new_callable=StringIO) as stderr:
+            with self.assertRaises(SystemExit):
+                main(['prerender', self.srcdir, self.outdir, '-j', '0'])
+        self.assertIn('-j: a positive number or "auto" is required: 0', stderr.getvalue())
+        self.assertFalse(os.path.exists(self.outdir))
+
+    def test_prerender_command_on_warm_outdir(self):
+        doctreedir = os.path.join(self.outdir, '.doctrees')
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, doctreedir, 'html', status=None)
+        app.build()
+
+        with open(os.path.join(self.srcdir, 'index.rst'), 'a') as fp:
+            fp.write('\n.. blockdiag::\n\n   A -> D;\n')
+        subprocess.check_call([sys.executable, '-m', 'sphinxcontrib.blockdiag', 'prerender', '-q',
+                               self.srcdir, self.outdir])
+
+        status = StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, doctreedir, 'html', status=status)
+        app.build()
+        self.assertIn('blockdiag: 3 diagrams reused, 0 regenerated', status.getvalue())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+
+
+ORPHAN = 'blockdiag-%s.png' % ('0' * 40)
+
+
+def with_prune_app(mode):
+    return with_app(srcdir='tests/docs/basic',
+                    buildername='html',
+                    write_docstring=True,
+                    confoverrides={'blockdiag_prune_images': mode})
+
+
+class TestSphinxcontribBlockdiagPrune(unittest.TestCase):
+    @with_prune_app(True)
+    def test_prune_images(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        imagedir = app.outdir / '_images'
+        os.makedirs(imagedir)
+        (imagedir / ORPHAN).write_text('')
+        (imagedir / 'other.png').write_text('')
+
+        app.build(True)
+        images = os.listdir(imagedir)
+        self.assertNotIn(ORPHAN, images)
+        self.assertIn('other.png', images)
+        self.assertEqual(1, len([name for name in images if name.startswith('blockdiag-')]))
+        self.assertIn('1 unreferenced images removed', status.getvalue())
+
+    @with_prune_app(True)
+    def test_prune_edited_diagram(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        old_images = os.listdir(app.outdir / '_images')
+
+        (app.srcdir / 'index.rst').write_text('.. blockdiag::\n\n   A -> C;\n', encoding='utf-8')
+        app.build()
+        new_images = os.listdir(app.outdir / '_images')
+        self.assertEqual(1, len(new_images))
+        self.assertNotEqual(old_images, new_images)
+
+    @with_prune_app('dry-run')
+    def test_prune_images_dry_run(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        imagedir = app.outdir / '_images'
+        os.makedirs(imagedir)
+        (imagedir / ORPHAN).write_text('')
+
+        app.build(True)
+        self.assertIn(ORPHAN, os.listdir(imagedir))
+        self.assertIn('1 unreferenced images found', status.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_prune_images': True, 'blockdiag_html_image_format': 'SVG'})
+    def test_prune_svg_cache(self, app, status, warning):
+        """
+        .. _target:
+
+        heading
+        -------
+
+        .. blockdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        cachedir = app.doctreedir / 'blockdiag'
+        app.build(True)
+        old_images = [name for name in os.listdir(cachedir) if name.endswith('.svg')]
+        self.assertEqual(1, len(old_images))
+
+        # the href is resolved to another URI; a new SVG is cached for the diagram
+        source = (app.srcdir / 'index.rst').read_text(encoding='utf-8')
+        (app.srcdir / 'index.rst').write_text(source.replace('.. _target:', '.. _other:'), encoding='utf-8')
+        app.build()
+        new_images = [name for name in os.listdir(cachedir) if name.endswith('.svg')]
+        self.assertEqual(1, len(new_images))
+        self.assertNotEqual(old_images, new_images)
+
+        # the diagram is edited
+        (app.srcdir / 'index.rst').write_text('.. blockdiag::\n\n   A -> C;\n', encoding='utf-8')
+        app.build()
+        images = [name for name in os.listdir(cachedir) if name.endswith('.svg')]
+        self.assertEqual(1, len(images))
+        self.assertNotEqual(new_images[0][:50], images[0][:50])
+        self.assertEqual([images[0][:50] + '.svg'], list(sphinxcontrib.blockdiag.metadata_index))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+from io import StringIO
+from shutil import rmtree
+from sphinx.application import Sphinx
+from sphinx_testing import with_app
+
+import unittest
+import sphinxcontrib.blockdiag
+
+
+with_report_app = with_app(srcdir='tests/docs/basic',
+                           buildername='html',
+                           write_docstring=True,
+                           confoverrides={'blockdiag_render_report': True})
+
+
+class TestSphinxcontribBlockdiagReport(unittest.TestCase):
+    @with_report_app
+    def test_render_report(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           A -> B -> C;
+
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        self.assertIn('blockdiag: 3 diagrams (1 cached, 2 rendered)', status.getvalue())
+
+        with open(app.doctreedir / 'blockdiag' / 'report.json', encoding='utf-8') as fp:
+            report = json.load(fp)
+        self.assertEqual(3, report['diagrams'])
+        self.assertEqual(1, report['cache_hits'])
+        self.assertEqual(2, report['cache_misses'])
+        self.assertEqual(dict(diagrams=3, total=report['total']), report['documents']['index'])
+
+        slowest = report['slowest']
+        self.assertEqual(2, len(slowest))
+        self.assertEqual(set([2, 3]), set(record['nodes'] for record in slowest))
+        self.assertEqual(set([1, 2]), set(record['edges'] for record in slowest))
+        for record in slowest:
+            self.assertGreater(record['layout'], 0)
+            self.assertGreater(record['draw'], 0)
+
+    @with_report_app
+    def test_text_metrics_report(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           A -> B -> C;
+        """
+        sphinxcontrib.blockdiag.text_metrics.clear()
+        app.build(True)
+        self.assertRegexpMatches(status.getvalue(), r'text metrics cache: \d+ hits, \d+ misses')
+
+        with open(app.doctreedir / 'blockdiag' / 'report.json', encoding='utf-8') as fp:
+            text_metrics = json.load(fp)['text_metrics']
+        self.assertGreater(text_metrics['hits'], 0)
+        self.assertGreater(text_metrics['misses'], 0)
+        self.assertEqual(float(text_metrics['hits']) / (text_metrics['hits'] + text_metrics['misses']),
+                         text_metrics['hit_rate'])
+
+    @with_report_app
+    def test_render_report_on_warm_build(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        app.build(True)
+        self.assertIn('blockdiag: 1 diagrams (1 cached, 0 rendered)', status.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={'blockdiag_render_report': 'report.json'})
+    def test_render_report_on_latex(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        with open(app.confdir / 'report.json', encoding='utf-8') as fp:
+            report = json.load(fp)
+        self.assertEqual(1, report['cache_misses'])
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'blockdiag_render_report': True, 'blockdiag_render_workers': 2})
+    def test_render_report_with_workers(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           group { X; Y; }
+           X -> Y;
+
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        self.assertIn('blockdiag: 3 diagrams (1 cached, 2 rendered)', status.getvalue())
+        self.assertIn('blockdiag: 1 diagrams reused, 2 regenerated', status.getvalue())
+
+        with open(app.doctreedir / 'blockdiag' / 'report.json', encoding='utf-8') as fp:
+            report = json.load(fp)
+        self.assertEqual([2, 2], sorted(record['nodes'] for record in report['slowest']))
+
+    @with_report_app
+    def test_render_report_cost(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           group { X; Y; }
+           X -> Y;
+        """
+        app.build(True)
+        with open(app.doctreedir / 'blockdiag' / 'report.json', encoding='utf-8') as fp:
+            record = json.load(fp)['records'][0]
+        complexity = app.env.blockdiag_diagrams['index'][0][3]
+        self.assertEqual(dict(nodes=2, edges=1, groups=1, depth=1, cost=4), complexity)
+        self.assertEqual((2, 1, 4), (record['nodes'], record['edges'], record['cost']))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True)
+    def test_no_records_without_report(self, app, status, warning):
+        """
+        .. blockdiag::
+
+           A -> B;
+
+        .. blockdiag::
+
+           A -> B;
+        """
+        app.build(True)
+        self.assertIn('blockdiag: 1 diagrams reused, 1 regenerated', status.getvalue())
+        self.assertFalse(os.path.exists(app.doctreedir / 'blockdiag' / 'report'))
+
+    def test_counts_of_parallel_writers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = os.path.join(tmpdir, 'src')
+            os.makedirs(srcdir)
+            with open(os.path.join(srcdir, 'conf.py'), 'w') as fp:
+                fp.write("extensions = ['sphinxcontrib.blockdiag']\n")
+            with open(os.path.join(srcdir, 'index.rst'), 'w') as fp:
+                fp.write('.. toctree::\n\n' + ''.join('   doc%d\n' % i for i in range(8)))
+            for i in range(8):
+                with open(os.path.join(srcdir, 'doc%d.rst' % i), 'w') as fp:
+                    fp.write('doc%d\n====\n\n.. blockdiag::\n\n   A -> B%d;\n' % (i, i))
+
+            status = StringIO()
+            app = Sphinx(srcdir, srcdir, os.path.join(tmpdir, 'out'), os.path.join(tmpdir, 'doctrees'),
+                         'html', status=status, parallel=2)
+            app.build()
+            self.assertIn('blockdiag: 0 diagrams reused, 8 regenerated', status.getvalue())
+
+            app.build(True)
+            self.assertIn('blockdiag: 8 diagrams reused, 0 regenerated', status.getvalue())
+        finally:
+            rmtree(tmpdir, True)